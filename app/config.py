@@ -15,13 +15,113 @@ class Config:
     CHUNK_SIZE = 1024
     CHUNK_OVERLAP = 200
     SIMILARITY_TOP_K = 5
+
+    # Resident index cache (estimated bytes of vectors + docstore text kept in memory)
+    INDEX_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+    # Similarity metric for new course indexes: "ip" (cosine over normalized vectors) or "l2"
+    VECTOR_METRIC = "ip"
+
+    # Approximate nearest-neighbour indexes ("auto" picks by course size, or force flat/ivf_flat/ivf_pq/hnsw)
+    ANN_INDEX_TYPE = "auto"
+    ANN_PROMOTE_THRESHOLD = 50_000  # vectors before a flat course index is promoted to IVF-Flat
+    ANN_PQ_THRESHOLD = 500_000  # vectors before IVF-Flat is replaced by IVF-PQ
+    ANN_NPROBE = 16
+    ANN_EF_SEARCH = 64
+    ANN_HNSW_M = 32
+
+    # Persistent embedding cache (rows in storage/embeddings.sqlite)
+    EMBEDDING_CACHE_MAX_ENTRIES = 500_000
+    EMBEDDING_CACHE_TOUCH_FLUSH_S = 30.0  # cache hits update last_used_at in one batched write at most this often
+
+    # Ingestion embedding: chunks per model batch, and batches embedded concurrently
+    EMBED_BATCH_SIZE = 64
+    EMBED_WORKERS = 2
+    INGEST_SECTION_CHARS = 32_000  # streamed files: consecutive pages are chunked together up to about this size
     
+    # Course material downloads (shared keep-alive HTTP client, content-addressed cache in storage/downloads)
+    HTTP_MAX_CONNECTIONS = 32
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+    HTTP_TIMEOUT_S = 60.0  # per read/write; large files stream for as long as data keeps arriving
+    HTTP_CONNECT_TIMEOUT_S = 10.0
+    DOWNLOAD_CONCURRENCY = 8
+    DOWNLOAD_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024
+
     # Moodle integration
     MOODLE_API_KEY = os.getenv("MOODLE_API_KEY")
     
     # Groq configuration
     GROQ_API_KEY = os.getenv("GROQ_API_KEY")
     GROQ_MODEL = "llama3-8b-8192"
+
+    # Prompt token budget (tiktoken when installed, otherwise ~4 characters per token)
+    LLM_CONTEXT_WINDOW = 8192
+    LLM_MAX_OUTPUT_TOKENS = 1024
+    LLM_TEMPERATURE = 0.3
+    PROMPT_SAFETY_TOKENS = 256  # slack for tokenizer mismatch with the served model
+    PROMPT_HISTORY_MAX_SHARE = 0.25  # of the input budget left after the fixed prompt
+    PROMPT_MIN_SOURCE_TOKENS = 96  # below this per source, lower-ranked sources are dropped instead
     
+    # Worker pools for blocking work called from async endpoints (0 = one CPU worker per core)
+    CPU_POOL_SIZE = 0
+    IO_POOL_SIZE = 32
+
+    # Background ingestion jobs (/activities)
+    INGESTION_WORKERS = 4
+    INGESTION_MAX_ATTEMPTS = 5
+    INGESTION_RETRY_BASE_S = 5  # backoff doubles per failed attempt
+    INGESTION_POLL_INTERVAL_S = 1.0
+    INGESTION_JOB_LEASE_S = 1800  # running jobs not heartbeated for this long are assumed lost and re-queued
+    INGESTION_HEARTBEAT_S = 60.0  # how often a running job renews its lease
+    INGESTION_STOP_TIMEOUT_S = 30.0  # shutdown waits this long for running jobs before cancelling them
+
+    # SQLite state databases (WAL mode; one writer connection plus pooled readers per file)
+    SQLITE_READ_POOL_SIZE = 8
+    SQLITE_CACHE_SIZE_KB = 16 * 1024  # page cache per connection
+    SQLITE_BUSY_TIMEOUT_MS = 30_000
+    SQLITE_STATEMENT_CACHE = 256  # prepared statements kept per connection
+
+    # Chat message write-behind buffer
+    SESSION_FLUSH_INTERVAL_S = 0.5  # longest a message stays buffered before it is committed
+    SESSION_FLUSH_MAX_BATCH = 256  # flush early once this many messages are buffered
+
+    # In-process cache of per-session chat context (status + newest messages)
+    SESSION_CONTEXT_CACHE_SIZE = 1024  # sessions
+    SESSION_CONTEXT_MAX_MESSAGES = 200  # newest messages kept per session
+
+    # Rolling chat summaries (sessions.summary_text), refreshed in the background
+    SESSION_SUMMARY_EVERY_TURNS = 4  # fold this many new turns into the summary at a time
+    SESSION_SUMMARY_KEEP_TURNS = 2  # newest turns always sent verbatim, never only as summary
+    SESSION_SUMMARY_MAX_WORDS = 200
+    SESSION_SUMMARY_INPUT_TOKENS = 3000  # cap on the new messages sent to the summarizer
+
+    # Document text extraction in worker processes, isolated from the API process
+    EXTRACTION_WORKERS = 0  # 0 = one per core
+    EXTRACTION_QUEUE_SIZE = 256  # files waiting for a worker before new ones are refused
+    EXTRACTION_TIMEOUT_S = 300  # per file; the worker is killed past this
+    EXTRACTION_TASKS_PER_CHILD = 100  # workers are replaced after this many files to cap parser memory growth
+
+    # Pipelined chat turns: expansion results not retrieved by this many seconds after the turn starts are skipped
+    CHAT_PIPELINE_DEADLINE_S = 4.0
+
+    # Semantic answer cache for standalone questions (per course, in memory)
+    ANSWER_CACHE_ENABLED = True
+    ANSWER_CACHE_SIMILARITY = 0.92  # cosine similarity between questions to reuse an answer
+    ANSWER_CACHE_TTL_S = 3600
+    ANSWER_CACHE_MAX_ENTRIES = 1000  # per course and endpoint
+
+    # Exact-match LLM response memoization (memory LRU in front of storage/llm_cache.sqlite)
+    LLM_CACHE_MEMORY_ENTRIES = 2048
+    LLM_CACHE_TTL_S = {  # per task_type; 0 disables caching for that task
+        "default": 3600,
+        "expansion": 24 * 3600,
+        "search": 3600,
+        "chat": 600,
+        "lesson": 7 * 24 * 3600,
+        "quiz": 7 * 24 * 3600,
+        "assignment": 7 * 24 * 3600,
+        "summary": 0,  # rolling summaries never repeat
+    }
+
     # Logging configuration
     LOG_LEVEL = "INFO"
\ No newline at end of file
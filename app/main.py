@@ -1,11 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from services import IndexManager, GenerationService, ResourceService, LessonService, ChatService, SessionStore
+from fastapi.responses import StreamingResponse
+from services import IndexManager, GenerationService, ResourceService, LessonService, ChatService, SessionStore, IngestionQueue, AnswerCache, DownloadCache, ExtractedTextCache
 from processors import get_processor
-from schemas import MoodleActivity, SearchRequest, SearchResponse, LessonCreateRequest, LessonCreateResponse, ResourceGenerateRequest, ResourceGenerateResponse, ChatResponse, ChatMessage
+from schemas import MoodleActivity, SearchRequest, SearchResponse, LessonCreateRequest, LessonCreateResponse, ResourceGenerateRequest, ResourceGenerateResponse, ChatResponse, ChatMessage, MessagePage
+import json
 import logging
 from config import Config
 from datetime import datetime, timedelta
+from typing import Optional
+from utils.concurrency import run_cpu, run_io, iterate_in_pool, shutdown_pools
+from utils.sqlite_pool import close_pools
+from utils.http_client import close_http_client
+from utils.extraction_pool import ExtractionPool
+from utils.prompt_packer import fit_sources
+from utils.singleflight import singleflight_stats
+from services.answer_cache import context_fingerprint
+from services.generation import GENERATION_FAILED
 
 app = FastAPI(title="Moodle Course Bot (LlamaIndex)", version="1.0.0")
 
@@ -20,54 +31,102 @@ app.add_middleware(
 
 session_store = SessionStore()
 
+
+async def run_ingestion_job(activity_type: str, course_id: str, content: dict):
+    processor = get_processor(activity_type)
+    if not processor:
+        raise ValueError(f"Unsupported activity type: {activity_type}")
+    result = await processor().process(course_id, content)
+    return result.model_dump() if result is not None else None
+
+
+ingestion_queue = IngestionQueue(handler=run_ingestion_job)
+
+def ndjson_response(events) -> StreamingResponse:
+    """Stream event dicts as newline-delimited JSON; blocking iterators are pulled on the IO pool"""
+    async def body():
+        stream = events if hasattr(events, "__aiter__") else iterate_in_pool(events)
+        async for event in stream:
+            yield json.dumps(event) + "\n"
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+def static_answer_events(answer: str, sources: Optional[list] = None):
+    yield {"type": "sources", "sources": sources or []}
+    yield {"type": "token", "content": answer}
+    yield {"type": "done", "answer": answer}
+
+
 # Initialize services on startup
 @app.on_event("startup")
 async def startup_event():
     level_name = getattr(Config, "LOG_LEVEL", "INFO")
     level = getattr(logging, level_name.upper(), logging.INFO)
     logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    ingestion_queue.start()
+    ExtractionPool().start()
     logging.info("Services initialized successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    try:
+        await ingestion_queue.stop()
+        # Commit buffered chat messages before the database connections go away
+        await run_io(session_store.stop)
+        await close_http_client()
+        ExtractionPool().shutdown()
+        shutdown_pools()
+        # Only if built: IndexManager() would otherwise load the embedding model just to shut down
+        if IndexManager._instance is not None:
+            IndexManager._instance.embedding_cache.flush_recency()
+    finally:
+        close_pools()
+
 @app.post("/activities", status_code=202)
 async def process_activity(activity: MoodleActivity):
     processor = get_processor(activity.type)
     if not processor:
         raise HTTPException(status_code=400, detail="Unsupported activity type")
-    print(activity)
-    await processor().process(activity.course_id, activity.content)
-    return {"status": "Processing started"}
+    job_id = await run_io(ingestion_queue.enqueue, activity.course_id, activity.type, activity.content)
+    return {"status": "Processing started", "job_id": job_id}
+
+@app.get("/activities/{job_id}")
+async def get_activity_job(job_id: str):
+    """Status of a background ingestion job"""
+    job = await run_io(ingestion_queue.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @app.post("/search", response_model=SearchResponse)
 async def search_content(request: SearchRequest):
     # Retrieve relevant nodes
-    nodes = IndexManager().search(request.course_id, request.query, top_k=request.top_k)
-    
-    # Optional threshold filtering
-    if request.threshold is not None:
-        try:
-            nodes = [n for n in nodes if getattr(n, "score", None) is not None and float(n.score) >= float(request.threshold)]
-        except Exception:
-            pass
+    # Scores are cosine similarities; the optional threshold is applied inside FAISS
+    index_version = IndexManager().index_version(request.course_id)
+    nodes = await run_cpu(
+        IndexManager().search,
+        request.course_id, request.query, top_k=request.top_k, threshold=request.threshold,
+        nprobe=request.nprobe, ef_search=request.ef_search,
+    )
     
     if not nodes:
+        if request.stream:
+            return ndjson_response(static_answer_events("No relevant information found"))
         return SearchResponse(
             answer="No relevant information found",
             sources=[]
         )
     
-    # Generate answer
+    # Generate answer; node text is packed to the prompt token budget, lowest-ranked sources trimmed first
+    packed = fit_sources(
+        [getattr(node, 'text', '') for node in nodes], request.query,
+        GenerationService().material_budget(request.query, task_type="search"), overhead_per_source=12,
+    )
     context = "\n\n".join([
-        f"Source {i+1} (Score: {getattr(node, 'score', 0.0):.2f}):\n{getattr(node, 'text', '')}" 
-        for i, node in enumerate(nodes)
+        f"Source {i+1} (Score: {getattr(node, 'score', 0.0):.2f}):\n{text}" 
+        for i, (node, text) in enumerate(zip(nodes, packed))
     ])
     
-    # Use the new generic interface, set task_type to "search" for clarity
-    answer = GenerationService().generate_response(
-        user_input=request.query,
-        material=context,
-        task_type="search"
-    )
-    
     # Format sources
     sources = []
     for node in nodes:
@@ -77,6 +136,43 @@ async def search_content(request: SearchRequest):
             "score": float(getattr(node, 'score', 0.0)),
             "metadata": metadata
         })
+
+    # Near-identical questions over the same retrieved context reuse a cached answer
+    cache_key = None
+    if Config.ANSWER_CACHE_ENABLED:
+        query_vectors = await run_cpu(IndexManager().embed_model.get_query_embedding_batch, [request.query])
+        cache_key = {"version": index_version, "query_vector": query_vectors[0], "fingerprint": context_fingerprint(nodes)}
+        cached = AnswerCache().lookup(request.course_id, "search", **cache_key)
+        if cached is not None:
+            if request.stream:
+                return ndjson_response(static_answer_events(cached["answer"], sources))
+            return SearchResponse(answer=cached["answer"], sources=sources)
+
+    def remember(answer: str, failed: bool) -> None:
+        if cache_key is not None and answer and not failed:
+            AnswerCache().store(request.course_id, "search", query=request.query, answer=answer, sources=sources, **cache_key)
+
+    if request.stream:
+        def events():
+            # Sources go out before the first token so the UI can render citations immediately
+            yield {"type": "sources", "sources": sources}
+            parts = []
+            tokens = GenerationService().stream_response(user_input=request.query, material=context, task_type="search")
+            for token in tokens:
+                parts.append(token)
+                yield {"type": "token", "content": token}
+            remember("".join(parts), failed=tokens.failed)
+            yield {"type": "done", "answer": "".join(parts)}
+        return ndjson_response(events())
+    
+    # Use the new generic interface, set task_type to "search" for clarity
+    answer = await run_io(
+        GenerationService().generate_response,
+        user_input=request.query,
+        material=context,
+        task_type="search"
+    )
+    remember(answer, failed=answer == GENERATION_FAILED)
     
     return SearchResponse(
         answer=answer,
@@ -88,10 +184,10 @@ async def chat(request: SearchRequest):
     """Chat endpoint using retrieved context and returning full session thread."""
     try:
         logging.info(f"Received chat request: {request.query} for course {request.course_id}")
-        if request.session_id is not None and not session_store.session_exists(request.session_id):
+        if request.session_id is not None and await run_io(session_store.get_context, request.session_id) is None:
             raise HTTPException(status_code=404, detail="Session not found or has ended")
         chat_service = ChatService()
-        result = chat_service.chat(
+        chat_kwargs = dict(
             course_id=request.course_id,
             query=request.query,
             top_k=request.top_k,
@@ -100,10 +196,25 @@ async def chat(request: SearchRequest):
             expand=bool(request.expand or False),
             num_expansions=int(request.num_expansions or 3),
             top_k_per_query=request.top_k_per_query,
+            nprobe=request.nprobe,
+            ef_search=request.ef_search,
         )
         sid = request.session_id or ""
-        messages_raw = session_store.get_session_messages(sid, limit=200) if sid else []
-        messages = [ChatMessage(role=m["role"], content=m["content"], created_at=m["created_at"]) for m in messages_raw]
+        if request.stream:
+            async def events():
+                async for event in chat_service.achat_stream(**chat_kwargs):
+                    if event["type"] == "done":
+                        event["session_id"] = sid
+                    yield event
+            return ndjson_response(events())
+        # Retrieval overlaps history loading and query expansion; blocking steps run on the worker pools
+        result = await chat_service.achat(**chat_kwargs)
+        messages_raw = result["messages"]
+        if request.include_thread and sid:
+            # The session context was updated in place by the turn, so this is a cache hit
+            context = await run_io(session_store.get_context, sid)
+            messages_raw = context.messages if context is not None else []
+        messages = [ChatMessage(**m) for m in messages_raw]
         return ChatResponse(session_id=sid, answer=result["answer"], sources=result["sources"], messages=messages)
     except HTTPException:
         raise
@@ -125,7 +236,7 @@ async def debug_course(course_id: str):
     if not index.course_index_exists(course_id):
         raise HTTPException(status_code=404, detail="Course index not found")
     try:
-        documents = index.get_course_documents(course_id)
+        documents = await run_cpu(index.get_course_documents, course_id)
         return {
             "course_id": course_id,
             "documents": [doc.to_dict() for doc in documents]
@@ -133,6 +244,37 @@ async def debug_course(course_id: str):
     except Exception as e:
         logging.error(f"Debug error for course {course_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e)) 
+
+@app.get("/debug/courses/{course_id}/ann-report")
+async def debug_ann_report(course_id: str, k: int = 10, num_queries: int = 100, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Recall-vs-latency of ANN index types against the flat baseline for one course"""
+    index = IndexManager()
+    if not index.course_index_exists(course_id):
+        raise HTTPException(status_code=404, detail="Course index not found")
+    try:
+        return {
+            "course_id": course_id,
+            "report": await run_cpu(
+                index.ann_report, course_id, num_queries=num_queries, k=k, nprobe=nprobe, ef_search=ef_search
+            ),
+        }
+    except Exception as e:
+        logging.error(f"ANN report error for course {course_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/debug/metrics")
+async def debug_metrics():
+    """Debug endpoint exposing in-process cache counters"""
+    return {
+        "index_cache": IndexManager().cache_stats(),
+        "embedding_cache": IndexManager().embedding_cache.stats(),
+        "answer_cache": AnswerCache().stats(),
+        "llm_cache": GenerationService().cache.stats(),
+        "downloads": DownloadCache().stats(),
+        "extracted_text": ExtractedTextCache().stats(),
+        "extraction_pool": ExtractionPool().stats(),
+        "singleflight": singleflight_stats(),
+    }
     
    
 
@@ -168,7 +310,7 @@ async def list_courses():
     """
     try:
         index_manager = IndexManager()
-        courses = index_manager.list_courses()
+        courses = await run_cpu(index_manager.list_courses)
         return {"courses": courses}
     except Exception as e:
         logging.error(f"Error listing courses: {str(e)}")
@@ -177,20 +319,46 @@ async def list_courses():
 @app.post("/chat/session")
 async def create_chat_session(course_id: str):
     try:
-        session_id = session_store.create_session(course_id)
+        session_id = await run_io(session_store.create_session, course_id)
         return {"session_id": session_id}
     except Exception as e:
         logging.error(f"Create session error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/chat/session/{session_id}/messages", response_model=MessagePage)
+async def get_chat_messages(session_id: str, after_created_at: Optional[str] = None,
+                            since_message_id: Optional[str] = None, limit: int = Query(50, ge=1, le=200)):
+    """Page through a session's thread, oldest first, starting after a cursor."""
+    try:
+        if not await run_io(session_store.session_exists, session_id):
+            raise HTTPException(status_code=404, detail="Session not found")
+        try:
+            messages, has_more = await run_io(
+                session_store.get_messages_page, session_id,
+                after_created_at=after_created_at, since_message_id=since_message_id, limit=limit,
+            )
+        except KeyError:
+            raise HTTPException(status_code=400, detail="Unknown since_message_id for this session")
+        return MessagePage(
+            session_id=session_id,
+            messages=[ChatMessage(**m) for m in messages],
+            has_more=has_more,
+            next_cursor=messages[-1]["id"] if messages else since_message_id,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"List messages error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/chat/end")
 async def end_chat_session(session_id: str, delete: bool = False):
     try:
-        if not session_store.session_exists(session_id):
+        if not await run_io(session_store.session_exists, session_id):
             raise HTTPException(status_code=404, detail="Session not found")
-        summary = session_store.end_session(session_id)
+        summary = await run_io(session_store.end_session, session_id)
         if delete:
-            session_store.delete_session(session_id)
+            await run_io(session_store.delete_session, session_id)
         return {"session_id": session_id, "summary": summary, "deleted": delete}
     except HTTPException:
         raise
@@ -201,9 +369,9 @@ async def end_chat_session(session_id: str, delete: bool = False):
 @app.delete("/chat/session/{session_id}")
 async def delete_chat_session(session_id: str):
     try:
-        if not session_store.session_exists(session_id):
+        if not await run_io(session_store.session_exists, session_id):
             raise HTTPException(status_code=404, detail="Session not found")
-        session_store.delete_session(session_id)
+        await run_io(session_store.delete_session, session_id)
         return {"session_id": session_id, "deleted": True}
     except HTTPException:
         raise
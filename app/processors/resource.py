@@ -1,31 +1,47 @@
 from .base import BaseProcessor
-from utils.moodle_helpers import download_file, extract_file_text
-from utils.llama_helpers import create_document, chunk_document
+from services.download_cache import DownloadCache
+from services.text_cache import ExtractedTextCache
+from models import ProcessedActivity
+from utils.concurrency import run_cpu, run_io
+import logging
 import mimetypes
+import time
 from typing import Dict
 
+logger = logging.getLogger(__name__)
+
 class ResourceProcessor(BaseProcessor):
-    async def process(self, course_id: str, content: Dict):
+    async def process(self, course_id: str, content: Dict) -> ProcessedActivity:
         file_url = content["file_path"]
-        print(file_url)
         file_type = content.get("file_type") or mimetypes.guess_extension(
             mimetypes.guess_type(file_url)[0] or "pdf"
         )
-        print(file_type)
-        # Download and extract text
-        file_path = download_file(file_url, suffix=file_type)
-        print(file_path)
-        text = extract_file_text(file_path, file_type)
-        print(text)
-        # Create document
-        document = create_document(text, {
+        logger.debug("resource.process: course=%s url=%s type=%s", course_id, file_url, file_type)
+        # Cached copy of the file (revalidated with a conditional request, streamed to disk when changed)
+        download = await DownloadCache().fetch(file_url)
+        file_path, file_digest = download.path, download.sha256
+        logger.debug("resource.process: %s cached at %s", file_url, file_path)
+        # Moodle re-sends unchanged files on every course edit; skip what is already indexed
+        activity = ProcessedActivity(course_id=course_id, activity_type="resource", content_hash=file_digest)
+        if await run_io(self.index_manager.has_document, course_id, file_digest):
+            logger.info("resource.skip: %s already indexed for course %s", file_url, course_id)
+            return activity
+        metadata = {
             "type": "resource",
             "file_type": file_type,
             "source": file_url,
             "course_id": course_id
-        })
-        print(document)
-        # Chunk and index
-        #chunks = chunk_document(document)
-        #print(f"Indexing {len(chunks)} chunks for course {course_id}")
-        self.index_manager.add_documents(course_id, documents=[document])
\ No newline at end of file
+        }
+        # Extract (or read back cached text), chunk (CHUNK_SIZE/CHUNK_OVERLAP) and embed page by page
+        started = time.perf_counter()
+        text_cache = ExtractedTextCache()
+        # Parsed in the extraction worker processes; the pages are then streamed back from the cache
+        await text_cache.ensure(file_path, file_digest, file_type)
+        pages = text_cache.pages(file_path, file_digest, file_type)
+        stats = await run_cpu(self.index_manager.add_document_pages, course_id, file_digest, pages, metadata)
+        elapsed = time.perf_counter() - started
+        logger.info(
+            "resource.indexed: %s course=%s chunks=%d skipped=%d %.1fs (%.1f chunks/s)",
+            file_url, course_id, stats["added"], stats["skipped"], elapsed, stats["added"] / max(elapsed, 1e-9),
+        )
+        return activity
@@ -18,6 +18,13 @@ class SearchRequest(BaseModel):
     expand: Optional[bool] = False
     num_expansions: Optional[int] = 3
     top_k_per_query: Optional[int] = None
+    # ANN tuning for large courses (ignored by flat indexes)
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    # Stream the answer as NDJSON events (sources, token..., done) instead of one JSON body
+    stream: Optional[bool] = False
+    # /chat returns only the messages added by this turn unless the whole (recent) thread is requested
+    include_thread: Optional[bool] = False
 
 class SearchResult(BaseModel):
     text: str
@@ -74,6 +81,7 @@ class ResourceGenerateResponse(BaseModel):
 
 # Chat-specific models
 class ChatMessage(BaseModel):
+    id: Optional[str] = None
     role: Literal["user", "assistant"]
     content: str
     created_at: Optional[str] = None
@@ -82,4 +90,11 @@ class ChatResponse(BaseModel):
     session_id: str
     answer: str
     sources: List[SearchResult]
-    messages: List[ChatMessage]
\ No newline at end of file
+    messages: List[ChatMessage]
+
+class MessagePage(BaseModel):
+    session_id: str
+    messages: List[ChatMessage]
+    has_more: bool
+    # Pass back as since_message_id to fetch the next page
+    next_cursor: Optional[str] = None
\ No newline at end of file
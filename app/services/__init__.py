@@ -6,6 +6,10 @@ from .chat_service import ChatService
 from .resource_service import ResourceService
 from .lesson_service import LessonService
 from .session_store import SessionStore
+from .ingestion_queue import IngestionQueue
+from .answer_cache import AnswerCache
+from .download_cache import DownloadCache
+from .text_cache import ExtractedTextCache
 
 __all__ = [
     "EmbeddingService",
@@ -15,4 +19,8 @@ __all__ = [
     "ResourceService",
     "LessonService",
     "SessionStore",
+    "IngestionQueue",
+    "AnswerCache",
+    "DownloadCache",
+    "ExtractedTextCache",
 ]
\ No newline at end of file
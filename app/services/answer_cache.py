@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def context_fingerprint(nodes: Sequence) -> str:
+    """Identity of a retrieved context: the set of node ids, independent of order and scores"""
+    node_ids = sorted(getattr(n, "node_id", "") for n in nodes)
+    return hashlib.sha256("\n".join(node_ids).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Entry:
+    query: str
+    answer: str
+    sources: List[Dict[str, Any]]
+    fingerprint: str
+    created_at: float
+
+
+class _CourseAnswers:
+    """Answered queries of one course and namespace, searchable by query embedding"""
+
+    def __init__(self, dimension: int, version: int):
+        self.version = version
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self.entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.next_id = 0
+
+    def remove(self, entry_ids: List[int]) -> None:
+        if not entry_ids:
+            return
+        self.index.remove_ids(np.asarray(entry_ids, dtype="int64"))
+        for entry_id in entry_ids:
+            self.entries.pop(entry_id, None)
+
+
+class AnswerCache:
+    """
+    Per-course semantic cache of generated answers.
+    A new question reuses a previous answer when its embedding is within
+    ANSWER_CACHE_SIMILARITY (cosine) of an answered one and retrieval returned
+    the same context. Entries expire after ANSWER_CACHE_TTL_S, the least
+    recently used go first past ANSWER_CACHE_MAX_ENTRIES per course, and a
+    course's entries are dropped when its index version changes.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._courses = {}  # (course_id, namespace) -> _CourseAnswers
+            cls._instance._lock = threading.Lock()
+            cls._instance.hits = 0
+            cls._instance.misses = 0
+            cls._instance.stores = 0
+            cls._instance.invalidations = 0
+        return cls._instance
+
+    def _course(self, course_id: str, namespace: str, dimension: int, version: int) -> Optional[_CourseAnswers]:
+        """The course's answers at this index version, or None if the caller's version is already outdated"""
+        key = (course_id, namespace)
+        answers = self._courses.get(key)
+        if answers is not None and answers.version > version:
+            return None
+        if answers is not None and answers.version != version:
+            self.invalidations += 1
+            logger.info("answer_cache.invalidate: course=%s ns=%s entries=%d", course_id, namespace, len(answers.entries))
+            answers = None
+        if answers is None:
+            answers = self._courses[key] = _CourseAnswers(dimension, version)
+        return answers
+
+    def lookup(self, course_id: str, namespace: str, version: int, query_vector: Sequence[float],
+               fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Cached {"answer", "sources", "query", "similarity"} for a near-identical question over the same context"""
+        vector = np.asarray([query_vector], dtype="float32")
+        with self._lock:
+            answers = self._course(course_id, namespace, vector.shape[1], version)
+            if answers is None or answers.index.ntotal == 0:
+                self.misses += 1
+                return None
+            similarities, entry_ids = answers.index.search(vector, min(8, answers.index.ntotal))
+            now = time.time()
+            expired = []
+            hit = None
+            for similarity, entry_id in zip(similarities[0], entry_ids[0]):
+                if entry_id < 0 or similarity < Config.ANSWER_CACHE_SIMILARITY:
+                    break
+                entry = answers.entries[int(entry_id)]
+                if now - entry.created_at > Config.ANSWER_CACHE_TTL_S:
+                    expired.append(int(entry_id))
+                    continue
+                if entry.fingerprint == fingerprint:
+                    answers.entries.move_to_end(int(entry_id))
+                    hit = {"answer": entry.answer, "sources": entry.sources, "query": entry.query,
+                           "similarity": float(similarity)}
+                    break
+            answers.remove(expired)
+            if hit is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return hit
+
+    def store(self, course_id: str, namespace: str, version: int, query: str, query_vector: Sequence[float],
+              fingerprint: str, answer: str, sources: List[Dict[str, Any]]) -> None:
+        vector = np.asarray([query_vector], dtype="float32")
+        with self._lock:
+            answers = self._course(course_id, namespace, vector.shape[1], version)
+            if answers is None:
+                return
+            entry_id = answers.next_id
+            answers.next_id += 1
+            answers.index.add_with_ids(vector, np.asarray([entry_id], dtype="int64"))
+            answers.entries[entry_id] = _Entry(query, answer, sources, fingerprint, time.time())
+            self.stores += 1
+            overflow = len(answers.entries) - Config.ANSWER_CACHE_MAX_ENTRIES
+            if overflow > 0:
+                answers.remove(list(answers.entries.keys())[:overflow])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "courses": len(self._courses),
+                "entries": sum(len(a.entries) for a in self._courses.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
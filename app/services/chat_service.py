@@ -1,18 +1,58 @@
-from typing import List, Dict, Optional, Tuple, Set
+from typing import List, Dict, Optional, Tuple, Set, AsyncIterator
 from uuid import uuid4
+import asyncio
+import functools
 import logging
 from itertools import chain
+from threading import Lock
 
 from services.index_manager import IndexManager
-from services.generation import GenerationService
-from services.session_store import SessionStore
+from services.generation import GenerationService, GENERATION_FAILED
+from services.session_store import SessionStore, SessionContext
+from services.answer_cache import AnswerCache, context_fingerprint
+from utils.prompt_packer import count_tokens, fit_history, fit_sources, oldest_that_fit, prompt_budget, truncate_to_tokens
+from utils.concurrency import IO_POOL, iterate_in_pool, run_cpu, run_io
+from config import Config
 
 logger = logging.getLogger(__name__)
 
+_SYSTEM_PROMPT = (
+    "You are a virtual tutor strictly grounded to the provided course context. "
+    "Answer only using information from Context. If the answer is not in Context, say you don’t have enough information. "
+    "Be concise, helpful, and include citations like [1], [2] that map to the sources."
+)
+
+_CHAT_TEMPLATE = (
+    "System:\n{system_prompt}\n\n"
+    "Context:\n{material}\n\n"
+    "Conversation so far:\n{history}\n\n"
+    "User:\n{user_input}\n\n"
+    "Assistant:"
+)
+
+_SUMMARY_TEMPLATE = (
+    "Update the running summary of a tutoring conversation between a student and a course tutor.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New messages:\n{material}\n\n"
+    "Write the updated summary in at most {max_words} words. Keep the topics covered, what the student was told, "
+    "the student's goals and any open questions. Reply with the summary only."
+)
+
+_EXPANSION_TEMPLATE = (
+    "You expand a student's question into {num} alternative search queries focused on the same topic.\n"
+    "Conversation so far (optional):\n{history}\n\n"
+    "Original question: {q}\n\n"
+    "Return ONLY the queries, one per line, concise and course-specific."
+)
+
+_ENDED_ANSWER = "This chat session has ended. Please start a new chat."
+
+# Tokens taken by each source's "[n] (score=0.00)" header and separator
+_SOURCE_HEADER_TOKENS = 12
+
 
 class ChatService:
     _instance = None
-    _sessions: Dict[str, List[Dict[str, str]]] = {}
 
     def __new__(cls):
         if cls._instance is None:
@@ -20,42 +60,81 @@ class ChatService:
             cls._instance.index_manager = IndexManager()
             cls._instance.generator = GenerationService()
             cls._instance.session_store = SessionStore()
+            cls._instance.answer_cache = AnswerCache()
+            cls._instance._summarizing = set()
+            cls._instance._summarizing_lock = Lock()
+            cls._instance._background = set()
         return cls._instance
 
-    def _ensure_session(self, session_id: Optional[str]) -> Optional[str]:
+    def _append_history(self, session_id: Optional[str], role: str, content: str) -> List[Dict]:
+        """Persist a message; returns it (as a one-item list) so the turn can report what it added"""
         if session_id is None:
-            return None
-        # initialize in-memory cache for quick short context (still persisted to DB)
-        if session_id not in self._sessions:
-            self._sessions[session_id] = []
-        return session_id
-
-    def _append_history(self, session_id: Optional[str], role: str, content: str) -> None:
-        if session_id is None:
-            return
-        self._sessions.setdefault(session_id, []).append({"role": role, "content": content})
-        # keep last 12 turns max
-        self._sessions[session_id] = self._sessions[session_id][-12:]
-        # persist
+            return []
+        # buffered by the store, which also updates its cached session context
         try:
-            self.session_store.add_message(session_id, role, content)
+            message = self.session_store.add_message(session_id, role, content)
         except Exception as e:
             logger.error(f"Failed to persist message for session {session_id}: {e}")
+            return []
+        if role == "assistant":
+            self._schedule_summary(session_id)
+        return [message]
 
-    def _format_history(self, session_id: Optional[str]) -> str:
-        if session_id is None:
-            return ""
+    def _schedule_summary(self, session_id: str) -> None:
+        """Fold older turns into the session's rolling summary in the background (at most one job per session)"""
+        with self._summarizing_lock:
+            if session_id in self._summarizing:
+                return
+            self._summarizing.add(session_id)
+        IO_POOL.submit(self._update_summary, session_id)
+
+    def _update_summary(self, session_id: str) -> None:
         try:
-            msgs = self.session_store.get_messages(session_id, limit=12)
-            return "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in msgs])
+            keep = Config.SESSION_SUMMARY_KEEP_TURNS * 2
+            while True:
+                session = self.session_store.get_context(session_id)
+                if session is None:
+                    return
+                pending = session.unsummarized()
+                if len(pending) < keep + Config.SESSION_SUMMARY_EVERY_TURNS * 2:
+                    return
+                # Oldest first, in chunks that fit the summarizer's input; summary_upto only moves past what it saw
+                fold = oldest_that_fit(pending[:len(pending) - keep], Config.SESSION_SUMMARY_INPUT_TOKENS)
+                summary = self.generator.generate_response(
+                    user_input="",
+                    material=fit_history(fold, Config.SESSION_SUMMARY_INPUT_TOKENS),
+                    task_type="summary",
+                    template=_SUMMARY_TEMPLATE,
+                    summary=session.summary or "(none yet)",
+                    max_words=Config.SESSION_SUMMARY_MAX_WORDS,
+                )
+                if not summary or summary == GENERATION_FAILED:
+                    logger.warning("chat.summary: generation failed for sid=%s; will retry next turn", session_id)
+                    return
+                self.session_store.set_summary(session_id, summary.strip(), fold[-1]["created_at"])
+                logger.info("chat.summary: sid=%s folded=%d", session_id, len(fold))
         except Exception as e:
-            logger.error(f"Failed to load messages for session {session_id}: {e}")
-            return "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in self._sessions.get(session_id, [])])
+            logger.error(f"Failed to update summary for session {session_id}: {e}")
+        finally:
+            with self._summarizing_lock:
+                self._summarizing.discard(session_id)
 
-    def _nodes_to_context_and_sources(self, nodes: List) -> Tuple[str, List[Dict]]:
-        context_lines: List[str] = []
+    def _format_history(self, session: Optional[SessionContext], max_tokens: int) -> str:
+        if session is None:
+            return ""
+        # Rolling summary plus the turns it does not cover yet (normally the last couple;
+        # capped at 12 messages if summarization lags), newest first until the budget is spent
+        recent = session.unsummarized()[-12:]
+        if not session.summary:
+            return fit_history(recent, max_tokens)
+        summary = truncate_to_tokens(f"Summary of earlier conversation: {session.summary}", max_tokens // 2)
+        return summary + "\n" + fit_history(recent, max_tokens - count_tokens(summary))
+
+    def _nodes_to_context_and_sources(self, nodes: List, query: str, max_tokens: int) -> Tuple[str, List[Dict]]:
+        """Sources carry the full node text; the prompt context is packed into max_tokens"""
+        texts: List[str] = []
         sources: List[Dict] = []
-        for idx, node in enumerate(nodes):
+        for node in nodes:
             text = getattr(node, "text", None)
             if text is None and hasattr(node, "get_content"):
                 try:
@@ -64,45 +143,64 @@ class ChatService:
                     text = ""
             score = getattr(node, "score", 0.0)
             metadata = getattr(node, "metadata", {}) or {}
-            context_lines.append(f"[{idx+1}] (score={float(score):.2f})\n{text}")
+            texts.append(text or "")
             sources.append({
                 "text": text or "",
                 "score": float(score) if isinstance(score, (int, float)) else 0.0,
                 "metadata": metadata,
             })
+        packed = fit_sources(texts, query, max_tokens, overhead_per_source=_SOURCE_HEADER_TOKENS)
+        context_lines = [
+            f"[{idx+1}] (score={src['score']:.2f})\n{text}" for idx, (src, text) in enumerate(zip(sources, packed))
+        ]
         return "\n\n".join(context_lines), sources
 
-    def _expand_queries(self, base_query: str, num: int, history: str) -> List[str]:
-        """Use LLM to generate paraphrases/expansions for retrieval."""
-        template = (
-            "You expand a student's question into {num} alternative search queries focused on the same topic.\n"
-            "Conversation so far (optional):\n{history}\n\n"
-            "Original question: {q}\n\n"
-            "Return ONLY the queries, one per line, concise and course-specific."
-        )
-        logger.debug("chat.expand: generating up to %d for %r", num, base_query)
+    def _expansion_args(self, base_query: str, num: int, history: str) -> Dict:
+        return {
+            "user_input": base_query,
+            "material": "",
+            "task_type": "expansion",
+            "template": _EXPANSION_TEMPLATE,
+            "num": num,
+            "history": history or "",
+            "q": base_query,
+        }
+
+    @staticmethod
+    def _accept_expansion(line: str, base_query: str, accepted: List[str], num: int) -> Optional[str]:
+        """The cleaned query on line if it is a new alternative and fewer than num were accepted, else None"""
+        q = line.strip("- • ").strip()
+        if not q or q == GENERATION_FAILED or q.lower() == base_query.lower() or q in accepted or len(accepted) >= num:
+            return None
+        return q
+
+    async def _aexpand_queries(self, base_query: str, num: int, history: str) -> AsyncIterator[str]:
+        """Use the LLM to generate paraphrases/expansions for retrieval, yielding each as soon as its line is complete"""
+        logger.debug("chat.expand: streaming up to %d for %r", num, base_query)
+        accepted: List[str] = []
+        buffer = ""
         try:
-            text = self.generator.generate_response(
-                user_input=base_query,
-                material="",
-                task_type="default",
-                template=template,
-                num=num,
-                history=history or "",
-                q=base_query,
-            )
+            tokens = await run_io(self.generator.stream_response, **self._expansion_args(base_query, num, history))
+            # Read to the end even after num queries, so the full response still reaches the LLM cache
+            async for token in iterate_in_pool(tokens):
+                if tokens.failed:
+                    # Whatever was streamed before the failure is an unfinished line; drop it
+                    logger.warning("chat.expand: generation failed part-way")
+                    return
+                buffer += token
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    q = self._accept_expansion(line, base_query, accepted, num)
+                    if q is not None:
+                        accepted.append(q)
+                        yield q
+            q = self._accept_expansion(buffer, base_query, accepted, num)
+            if q is not None:
+                accepted.append(q)
+                yield q
         except Exception as e:
             logger.warning("chat.expand: generation failed: %s", e)
-            return []
-        queries = [line.strip("- • ").strip() for line in text.splitlines() if line.strip()]
-        out: List[str] = []
-        for q in queries:
-            if q and q.lower() != base_query.lower() and q not in out:
-                out.append(q)
-            if len(out) >= num:
-                break
-        logger.debug("chat.expand: got %d → %s", len(out), out)
-        return out
+        logger.debug("chat.expand: got %d → %s", len(accepted), accepted)
 
     def _merge_results(self, results_lists: List[List], max_k: int) -> List:
         """Merge nodes from multiple queries with simple de-dup (by text) and take top by score."""
@@ -122,95 +220,195 @@ class ChatService:
         logger.info("chat.select: merged=%d return=%d", len(merged), max_k)
         return merged[:max_k]
 
-    def chat(self, *, course_id: str, query: str, top_k: Optional[int] = None, threshold: Optional[float] = None, session_id: Optional[str] = None, expand: bool = False, num_expansions: int = 3, top_k_per_query: Optional[int] = None) -> Dict:
-        # Validate/ensure session if provided
-        session_id = self._ensure_session(session_id)
+    def _open_turn(self, query: str, session_id: Optional[str]) -> Optional[Tuple[Optional[SessionContext], int, str]]:
+        """Session context, prompt token budget and formatted history for a turn; None if the session has ended"""
+        # One lookup (usually an in-process cache hit) covers existence and history
+        session = self.session_store.get_context(session_id) if session_id is not None else None
+        if session_id is not None and session is None:
+            return None
+        # Token budget: the answer and fixed prompt parts are reserved, history gets at most its share
+        budget = prompt_budget(_CHAT_TEMPLATE.format(system_prompt=_SYSTEM_PROMPT, material="", history="", user_input=query))
+        history_str = self._format_history(session, int(budget * Config.PROMPT_HISTORY_MAX_SHARE))
+        return session, budget, history_str
 
+    async def _aprepare_turn(self, *, course_id: str, query: str, top_k: Optional[int] = None, threshold: Optional[float] = None, session_id: Optional[str] = None, expand: bool = False, num_expansions: int = 3, top_k_per_query: Optional[int] = None, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> Dict:
+        """
+        Everything in a chat turn up to the LLM call: history, retrieval and prompt.
+        Returns either a final {"answer", "sources", "messages"} (ended session / no context)
+        or {"sources", "messages", "cache_key", "generation"} with the generate_response arguments;
+        "messages" lists the messages this turn added to the session.
+        Retrieval for the original query starts at once, alongside loading the session history;
+        with expand, the expansion request is streamed meanwhile. The alternative queries it has
+        produced by CHAT_PIPELINE_DEADLINE_S after the turn started are searched together in one
+        search_many call (one embedding batch, one FAISS search); later ones are left out, so the
+        turn takes about max(expansion, retrieval) rather than their sum.
+        """
         logger.info(
-            "chat.request: course=%s sid=%s expand=%s top_k=%s thr=%s", course_id, session_id, expand, top_k, threshold
+            "chat.request: course=%s sid=%s expand=%s top_k=%s thr=%s pipelined", course_id, session_id, expand, top_k, threshold
         )
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + Config.CHAT_PIPELINE_DEADLINE_S
+        search = functools.partial(
+            self.index_manager.search_many, course_id,
+            top_k=top_k_per_query or top_k or 5, threshold=threshold, nprobe=nprobe, ef_search=ef_search,
+        )
+        # Read before retrieval, so an answer is never cached under a newer index than it was built from
+        index_version = self.index_manager.index_version(course_id)
+        base = asyncio.ensure_future(run_cpu(search, [query]))
 
-        if session_id is not None and not self.session_store.session_exists(session_id):
-            return {"answer": "This chat session has ended. Please start a new chat.", "sources": []}
+        opened = await run_io(self._open_turn, query, session_id)
+        if opened is None:
+            base.cancel()
+            return {"answer": _ENDED_ANSWER, "sources": [], "messages": []}
+        session, budget, history_str = opened
 
-        # Retrieve (optionally with query expansion)
-        effective_top_k = top_k or 5
-        per_query_k = top_k_per_query or effective_top_k
-        results_lists: List[List] = []
+        expansions: List[str] = []
+        if expand:
+            async def collect_expansions():
+                async for q in self._aexpand_queries(query, num_expansions, history_str):
+                    expansions.append(q)
 
-        history_str = self._format_history(session_id)
+            expander = asyncio.ensure_future(collect_expansions())
+            await asyncio.wait([expander], timeout=max(0.0, deadline - loop.time()))
+            if not expander.done():
+                # Not cancelled: the stream is read to the end in the background (see _aexpand_queries)
+                self._keep_background(expander)
+                logger.warning("chat.pipeline: expansion still running at the %.1fs deadline", Config.CHAT_PIPELINE_DEADLINE_S)
+            expansions = list(expansions)
 
-        if expand:
-            expansions = self._expand_queries(query, num=num_expansions, history=history_str)
-            all_queries = [query] + expansions
-            logger.info("chat.expand: base+alt=%d", len(all_queries))
-            logger.debug("chat.expand.queries=%s", all_queries)
-        else:
-            all_queries = [query]
-
-        for q in all_queries:
-            nodes = self.index_manager.search(course_id, q, top_k=per_query_k)
+        # The original query's results are needed whatever the deadline
+        all_queries = [query]
+        retrieved = [(await base)[0]]
+        if expansions:
+            batch = asyncio.ensure_future(run_cpu(search, expansions))
+            await asyncio.wait([batch], timeout=max(0.0, deadline - loop.time()))
+            if not batch.done():
+                batch.add_done_callback(lambda f: f.cancelled() or f.exception())
+                logger.warning("chat.pipeline: retrieval for %d expansions missed the deadline", len(expansions))
+            elif batch.exception() is not None:
+                logger.warning("chat.pipeline: retrieval failed for expansions %s: %s", expansions, batch.exception())
+            else:
+                all_queries += expansions
+                retrieved += batch.result()
+        logger.info(
+            "chat.pipeline: base+alt=%d elapsed=%.3fs", len(all_queries), loop.time() - started
+        )
+        return await run_cpu(
+            self._finish_turn, course_id=course_id, query=query, session_id=session_id, session=session,
+            index_version=index_version, budget=budget, history_str=history_str, all_queries=all_queries,
+            retrieved=retrieved, top_k=top_k or 5, threshold=threshold,
+        )
+
+    def _keep_background(self, task: asyncio.Future) -> None:
+        """Hold a reference to a task left running past the turn until it finishes"""
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _finish_turn(self, *, course_id: str, query: str, session_id: Optional[str], session: Optional[SessionContext],
+                     index_version: int, budget: int, history_str: str, all_queries: List[str], retrieved: List[List],
+                     top_k: int, threshold: Optional[float]) -> Dict:
+        """Second half of _aprepare_turn: merge the retrieved nodes, try the answer cache and pack the prompt"""
+        results_lists: List[List] = []
+        for q, nodes in zip(all_queries, retrieved):
             top_score = 0.0
             if nodes:
                 try:
                     top_score = float(getattr(nodes[0], "score", 0.0) or 0.0)
                 except Exception:
                     top_score = 0.0
-            logger.debug("chat.retrieve: q=%r nodes=%d top=%.2f", q, len(nodes or []), top_score)
-            if threshold is not None:
-                try:
-                    before = len(nodes)
-                    nodes = [n for n in nodes if getattr(n, "score", None) is not None and float(n.score) >= float(threshold)]
-                    logger.debug("chat.filter: thr=%s kept %d/%d", threshold, len(nodes), before)
-                except Exception as e:
-                    logger.debug("chat.filter: failed: %s", e)
+            logger.debug("chat.retrieve: q=%r nodes=%d top=%.2f thr=%s", q, len(nodes or []), top_score, threshold)
             results_lists.append(nodes)
 
-        nodes = self._merge_results(results_lists, max_k=effective_top_k)
+        nodes = self._merge_results(results_lists, max_k=top_k)
         logger.info("chat.select: final=%d", len(nodes))
 
         # If no context
         if not nodes:
             answer = "I couldn’t find relevant information in this course to answer that."
-            if session_id:
-                self._append_history(session_id, "user", query)
-                self._append_history(session_id, "assistant", answer)
+            messages = self._append_history(session_id, "user", query) + self._append_history(session_id, "assistant", answer)
             logger.info("chat.answer: no-context fallback")
-            return {"answer": answer, "sources": []}
+            return {"answer": answer, "sources": [], "messages": messages}
 
-        # Build system prompt and context
-        system_prompt = (
-            "You are a virtual tutor strictly grounded to the provided course context. "
-            "Answer only using information from Context. If the answer is not in Context, say you don’t have enough information. "
-            "Be concise, helpful, and include citations like [1], [2] that map to the sources."
+        # Standalone questions may reuse an answer to a near-identical question over the same context;
+        # follow-ups depend on the conversation, so sessions with history bypass the cache
+        cache_key = None
+        if Config.ANSWER_CACHE_ENABLED and (session is None or not session.messages):
+            cache_key = {
+                "version": index_version,
+                "query_vector": self.index_manager.embed_model.get_query_embedding_batch([query])[0],
+                "fingerprint": context_fingerprint(nodes),
+            }
+            cached = self.answer_cache.lookup(course_id, "chat", **cache_key)
+            if cached is not None:
+                messages = self._append_history(session_id, "user", query) + self._append_history(session_id, "assistant", cached["answer"])
+                logger.info("chat.answer: cache hit sim=%.3f", cached["similarity"])
+                return {"answer": cached["answer"], "sources": cached["sources"], "messages": messages}
+
+        # Build context in whatever budget the history left
+        context_budget = budget - count_tokens(history_str)
+        context, sources = self._nodes_to_context_and_sources(nodes, query, context_budget)
+        logger.info(
+            "chat.pack: budget=%d history=%d context=%d", budget, count_tokens(history_str), count_tokens(context)
         )
-        context, sources = self._nodes_to_context_and_sources(nodes)
 
         # Append user message to history
-        if session_id:
-            self._append_history(session_id, "user", query)
-
-        # Compose template
-        template = (
-            "System:\n{system_prompt}\n\n"
-            "Context:\n{material}\n\n"
-            "Conversation so far:\n{history}\n\n"
-            "User:\n{user_input}\n\n"
-            "Assistant:"
-        )
+        messages = self._append_history(session_id, "user", query)
 
-        # Generate
-        answer = self.generator.generate_response(
-            user_input=query,
-            material=context,
-            task_type="chat",
-            template=template,
-            system_prompt=system_prompt,
-            history=history_str,
-        )
+        return {
+            "sources": sources,
+            "messages": messages,
+            "cache_key": cache_key,
+            "generation": {
+                "user_input": query,
+                "material": context,
+                "task_type": "chat",
+                "template": _CHAT_TEMPLATE,
+                "system_prompt": _SYSTEM_PROMPT,
+                "history": history_str,
+            },
+        }
+
+    def _store_answer(self, course_id: str, query: str, turn: Dict, answer: str, failed: bool) -> None:
+        """Offer a generated answer to the semantic cache; failed or partial answers are never stored"""
+        if turn.get("cache_key") is None or not answer or failed:
+            return
+        self.answer_cache.store(course_id, "chat", query=query, answer=answer, sources=turn["sources"], **turn["cache_key"])
+
+    async def achat(self, **kwargs) -> Dict:
+        """Run a full chat turn and return the answer, its sources and the messages it added (see _aprepare_turn for arguments)."""
+        turn = await self._aprepare_turn(**kwargs)
+        if "answer" in turn:
+            return turn
+
+        answer = await run_io(self.generator.generate_response, **turn["generation"])
         logger.info("chat.answer: length=%d", len(answer or ""))
 
-        if session_id:
-            self._append_history(session_id, "assistant", answer)
+        self._store_answer(kwargs["course_id"], kwargs["query"], turn, answer, failed=answer == GENERATION_FAILED)
+        messages = turn["messages"] + await run_io(self._append_history, kwargs.get("session_id"), "assistant", answer)
+        return {"answer": answer, "sources": turn["sources"], "messages": messages}
+
+    async def achat_stream(self, **kwargs) -> AsyncIterator[Dict]:
+        """
+        Streaming variant of achat: yields a "sources" event as soon as retrieval is done,
+        then "token" events as the LLM produces them, then "done" with the full answer and new messages.
+        The assistant message is persisted once the stream completes.
+        """
+        turn = await self._aprepare_turn(**kwargs)
+        yield {"type": "sources", "sources": turn["sources"]}
+        if "answer" in turn:
+            yield {"type": "token", "content": turn["answer"]}
+            yield {"type": "done", "answer": turn["answer"], "messages": turn["messages"]}
+            return
+
+        parts: List[str] = []
+        tokens = await run_io(self.generator.stream_response, **turn["generation"])
+        async for token in iterate_in_pool(tokens):
+            parts.append(token)
+            yield {"type": "token", "content": token}
+        answer = "".join(parts)
+        logger.info("chat.answer: streamed length=%d", len(answer))
+        self._store_answer(kwargs["course_id"], kwargs["query"], turn, answer, failed=tokens.failed)
 
-        return {"answer": answer, "sources": sources} 
\ No newline at end of file
+        messages = turn["messages"] + await run_io(self._append_history, kwargs.get("session_id"), "assistant", answer)
+        yield {"type": "done", "answer": answer, "messages": messages}
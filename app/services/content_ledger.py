@@ -0,0 +1,51 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class ContentLedger:
+    """
+    Persistent per-course record of what has already been indexed:
+    document hash -> node ids, and chunk hash -> node id.
+    Lives next to the FAISS files in course_<id>/ and is removed with them.
+    """
+
+    FILENAME = "content_ledger.json"
+
+    def __init__(self, course_path: Path):
+        self.path = Path(course_path) / self.FILENAME
+        self.documents: Dict[str, List[str]] = {}
+        self.chunks: Dict[str, str] = {}
+        if self.path.exists():
+            data = json.loads(self.path.read_text())
+            self.documents = data.get("documents", {})
+            self.chunks = data.get("chunks", {})
+
+    def has_document(self, doc_hash: str) -> bool:
+        return doc_hash in self.documents
+
+    def document_chunks(self, doc_hash: str) -> int:
+        """Number of chunks an indexed document was split into (0 if unknown)"""
+        return len(self.documents.get(doc_hash, []))
+
+    def chunk_node_id(self, chunk_hash: str) -> Optional[str]:
+        return self.chunks.get(chunk_hash)
+
+    def record_chunk(self, chunk_hash: str, node_id: str) -> None:
+        self.chunks[chunk_hash] = node_id
+
+    def record_document(self, doc_hash: str, node_ids: List[str]) -> None:
+        self.documents[doc_hash] = node_ids
+
+    def clear(self) -> None:
+        self.documents = {}
+        self.chunks = {}
+
+    def save(self, course_path: Optional[Path] = None) -> None:
+        """Write the ledger to its course directory, or into course_path (e.g. a staged copy of it)"""
+        path = Path(course_path) / self.FILENAME if course_path is not None else self.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"documents": self.documents, "chunks": self.chunks}))
+        os.replace(tmp_path, path)
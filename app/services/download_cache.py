@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import Config
+from utils.concurrency import run_io
+from utils.hashing import file_hash
+from utils.http_client import get_http_client
+from utils.sqlite_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = Path(Config.STORAGE_PATH) / "downloads.sqlite"
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS downloads (
+        url TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        fetched_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_downloads_lru ON downloads(last_used_at);",
+    "CREATE INDEX IF NOT EXISTS idx_downloads_sha ON downloads(sha256);",
+]
+
+# Response bytes buffered before each disk write
+_WRITE_CHUNK_BYTES = 1024 * 1024
+
+
+@dataclass
+class CachedFile:
+    path: str
+    sha256: str
+    size: int
+
+
+class DownloadCache:
+    """
+    Local copies of course files, stored once per content under storage/downloads/<sha256>.
+    Each URL remembers its file with the ETag/Last-Modified it was served with, so fetching
+    it again is a conditional request that costs a 304 while the file is unchanged.
+    Interrupted downloads are kept as .part files and resumed with a Range request when the
+    server can validate them (If-Range). Least recently used files are evicted past
+    DOWNLOAD_CACHE_MAX_BYTES. Concurrent fetches of one URL share a single download.
+    """
+    _instance = None
+
+    def __new__(cls, root: Optional[Path] = None):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.root = Path(root or Path(Config.STORAGE_PATH) / "downloads")
+            cls._instance.root.mkdir(parents=True, exist_ok=True)
+            cls._instance._pool = get_pool(_DB_PATH)
+            cls._instance._inflight = {}  # url -> asyncio.Task
+            cls._instance._limits = {}  # event loop -> asyncio.Semaphore
+            cls._instance.revalidated = 0
+            cls._instance.downloads = 0
+            cls._instance.resumed = 0
+            cls._instance._init_db()
+        return cls._instance
+
+    def _init_db(self) -> None:
+        with self._pool.writer() as conn:
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+
+    def _limit(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._limits.get(loop)
+        if semaphore is None:
+            semaphore = self._limits[loop] = asyncio.Semaphore(Config.DOWNLOAD_CONCURRENCY)
+        return semaphore
+
+    def _blob_path(self, sha256: str) -> Path:
+        return self.root / sha256
+
+    async def fetch(self, url: str) -> CachedFile:
+        """Local copy of url, downloaded or revalidated as needed"""
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.ensure_future(self._fetch(url))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # One caller giving up must not cancel the download for the others
+        return await asyncio.shield(task)
+
+    def _lookup(self, url: str) -> Optional[Dict]:
+        with self._pool.reader() as conn:
+            row = conn.execute("SELECT sha256, size, etag, last_modified FROM downloads WHERE url=?", (url,)).fetchone()
+        if row is None or not self._blob_path(row["sha256"]).exists():
+            return None
+        return dict(row)
+
+    def _touch(self, url: str) -> None:
+        with self._pool.writer() as conn:
+            conn.execute("UPDATE downloads SET last_used_at=? WHERE url=?", (time.time(), url))
+
+    async def _fetch(self, url: str) -> CachedFile:
+        entry = await run_io(self._lookup, url)
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        part = self.root / f"{key}.part"
+        part_meta = self.root / f"{key}.part.json"
+        # Ranges and the stored digest refer to the file itself, not a compressed transfer of it
+        headers = {"Accept-Encoding": "identity"}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        offset = await run_io(self._resume_offset, url, part, part_meta)
+        if offset:
+            meta = json.loads(part_meta.read_text())
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = meta["etag"] or meta["last_modified"]
+
+        async with self._limit():
+            async with get_http_client().stream("GET", url, headers=headers) as response:
+                if response.status_code == 304 and entry is not None:
+                    await run_io(self._touch, url)
+                    self.revalidated += 1
+                    logger.info("download.revalidated: %s", url)
+                    return CachedFile(str(self._blob_path(entry["sha256"])), entry["sha256"], entry["size"])
+                if response.status_code == 206 and offset:
+                    self.resumed += 1
+                    logger.info("download.resume: %s from byte %d", url, offset)
+                elif response.status_code == 200:
+                    offset = 0
+                elif response.status_code == 416 and offset:
+                    # The partial file no longer matches what the server has; start over next time
+                    part.unlink(missing_ok=True)
+                    part_meta.unlink(missing_ok=True)
+                    raise ValueError(f"Failed to resume download from URL: {url} (HTTP 416)")
+                else:
+                    raise ValueError(f"Failed to download file from URL: {url} (HTTP {response.status_code})")
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                resumable = bool(etag or last_modified)
+                if resumable:
+                    part_meta.write_text(json.dumps({"url": url, "etag": etag, "last_modified": last_modified}))
+                try:
+                    await self._receive(response, part, append=offset > 0)
+                except BaseException:
+                    if not resumable:
+                        part.unlink(missing_ok=True)
+                    raise
+
+        cached = await run_io(self._store, url, part, etag, last_modified)
+        part_meta.unlink(missing_ok=True)
+        self.downloads += 1
+        logger.info("download.stored: %s sha=%s size=%d", url, cached.sha256[:12], cached.size)
+        return cached
+
+    @staticmethod
+    def _resume_offset(url: str, part: Path, part_meta: Path) -> int:
+        """Bytes of an interrupted download of url that can be resumed, or 0"""
+        if not part.exists() or not part_meta.exists():
+            part.unlink(missing_ok=True)
+            return 0
+        meta = json.loads(part_meta.read_text())
+        if meta.get("url") != url or not (meta.get("etag") or meta.get("last_modified")):
+            return 0
+        return part.stat().st_size
+
+    async def _receive(self, response, part: Path, append: bool) -> None:
+        with open(part, "ab" if append else "wb") as f:
+            buffer = bytearray()
+            try:
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
+                    if len(buffer) >= _WRITE_CHUNK_BYTES:
+                        await run_io(f.write, bytes(buffer))
+                        buffer.clear()
+            finally:
+                # Also on failure: whatever arrived is kept for a resumed download
+                f.write(buffer)
+
+    def _store(self, url: str, part: Path, etag: Optional[str], last_modified: Optional[str]) -> CachedFile:
+        """Move a completed download to its content address and record it for url"""
+        sha256 = file_hash(str(part))
+        size = part.stat().st_size
+        blob = self._blob_path(sha256)
+        if blob.exists():
+            part.unlink()
+        else:
+            os.replace(part, blob)
+        now = time.time()
+        with self._pool.writer() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads(url, sha256, size, etag, last_modified, fetched_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, sha256, size, etag, last_modified, now, now),
+            )
+        self._evict(keep=sha256)
+        return CachedFile(str(blob), sha256, size)
+
+    def _evict(self, keep: str) -> None:
+        """Drop the least recently used files until the cache fits DOWNLOAD_CACHE_MAX_BYTES"""
+        with self._pool.writer() as conn:
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM downloads GROUP BY sha256)"
+            ).fetchone()[0]
+            if total <= Config.DOWNLOAD_CACHE_MAX_BYTES:
+                return
+            rows = conn.execute(
+                "SELECT sha256, MAX(size) AS size, MAX(last_used_at) AS used FROM downloads "
+                "WHERE sha256 != ? GROUP BY sha256 ORDER BY used",
+                (keep,),
+            ).fetchall()
+            for row in rows:
+                if total <= Config.DOWNLOAD_CACHE_MAX_BYTES:
+                    break
+                conn.execute("DELETE FROM downloads WHERE sha256=?", (row["sha256"],))
+                self._blob_path(row["sha256"]).unlink(missing_ok=True)
+                total -= row["size"]
+                logger.info("download.evict: sha=%s size=%d", row["sha256"][:12], row["size"])
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "downloads": self.downloads,
+            "revalidated": self.revalidated,
+            "resumed": self.resumed,
+            "in_flight": len(self._inflight),
+        }
@@ -1,7 +1,16 @@
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode
+from services.embedding_cache import EmbeddingCache
+from utils.concurrency import EMBED_POOL
 from config import Config
+from collections import deque
+from typing import Iterable, Iterator, List, Optional
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 class EmbeddingService:
@@ -18,4 +27,99 @@ class EmbeddingService:
         return cls._instance
     
     def get_model(self):
-        return self.model
\ No newline at end of file
+        return self.model
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model so text and query vectors are served from EmbeddingCache when possible.
+    With normalize=True every returned vector has unit length, so inner product equals cosine similarity.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _normalize: bool = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, normalize: bool = True):
+        super().__init__(model_name=inner.model_name, embed_batch_size=inner.embed_batch_size)
+        self._inner = inner
+        self._cache = cache
+        self._normalize = normalize
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _embed_cached(self, kind: str, texts: List[str], compute) -> List[List[float]]:
+        vectors = self._cache.get_many(self.model_name, kind, texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            computed = compute([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+            self._cache.put_many(self.model_name, kind, [texts[i] for i in missing], computed)
+        if self._normalize:
+            matrix = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            vectors = (matrix / np.maximum(norms, 1e-12)).tolist()
+        return vectors
+
+    def _compute_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        # Without a query instruction, query and text encodings coincide and can share one batched forward pass
+        if not getattr(self._inner, "query_instruction", None):
+            return self._inner._get_text_embeddings(queries)
+        return [self._inner._get_query_embedding(q) for q in queries]
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """Embed several queries, computing all cache misses in a single batch"""
+        return self._embed_cached("query", queries, self._compute_query_embeddings)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.get_query_embedding_batch([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_cached("text", texts, self._inner._get_text_embeddings)
+
+
+def embed_nodes_batched(embed_model: BaseEmbedding, nodes: Iterable[BaseNode],
+                        batch_size: Optional[int] = None) -> Iterator[List[BaseNode]]:
+    """
+    Set node.embedding for nodes, EMBED_BATCH_SIZE at a time across the EMBED_POOL workers.
+    Nodes are consumed lazily and each batch is yielded, in input order, once embedded;
+    at most two batches per worker are pending, so memory stays bounded for any input size.
+    """
+    batch_size = batch_size or Config.EMBED_BATCH_SIZE
+    max_pending = 2 * Config.EMBED_WORKERS
+    pending = deque()
+
+    def submit(batch: List[BaseNode]) -> None:
+        # Same text LlamaIndex embeds, so vectors (and embedding cache keys) match index-time embedding
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        pending.append((batch, EMBED_POOL.submit(embed_model.get_text_embedding_batch, texts)))
+
+    def collect() -> List[BaseNode]:
+        batch, future = pending.popleft()
+        for node, vector in zip(batch, future.result()):
+            node.embedding = vector
+        return batch
+
+    batch: List[BaseNode] = []
+    for node in nodes:
+        if node.embedding is not None:
+            continue
+        batch.append(node)
+        if len(batch) == batch_size:
+            submit(batch)
+            batch = []
+            if len(pending) >= max_pending:
+                yield collect()
+    if batch:
+        submit(batch)
+    while pending:
+        yield collect()
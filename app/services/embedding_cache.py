@@ -0,0 +1,143 @@
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Any, Tuple
+import logging
+
+import numpy as np
+
+from config import Config
+from utils.hashing import content_hash
+from utils.sqlite_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = Path(Config.STORAGE_PATH) / "embeddings.sqlite"
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        model TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        text_hash TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        last_used_at REAL NOT NULL,
+        PRIMARY KEY (model, kind, text_hash)
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_embeddings_lru ON embeddings(last_used_at);",
+]
+
+
+class EmbeddingCache:
+    """
+    Disk-backed embedding cache keyed by (model, kind, normalized text hash).
+    Vectors are stored as raw float32 blobs; the least recently used rows are
+    evicted once the table grows past max_entries. Lookups only read (pooled WAL
+    readers); hits are timestamped in memory and written in one batch at most every
+    EMBEDDING_CACHE_TOUCH_FLUSH_S, and always before an eviction.
+    """
+
+    def __init__(self, db_path: Optional[Path] = None, max_entries: Optional[int] = None):
+        self.db_path = Path(db_path or _DB_PATH)
+        self.max_entries = max_entries or Config.EMBEDDING_CACHE_MAX_ENTRIES
+        self._pool = get_pool(self.db_path)
+        self._lock = threading.Lock()
+        self._touched: Dict[Tuple[str, str, str], float] = {}  # (model, kind, text_hash) -> last hit
+        self._touched_at = time.monotonic()
+        with self._pool.writer() as conn:
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, model: str, kind: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached vectors aligned with texts; None where the text has not been embedded yet"""
+        hashes = [content_hash(t) for t in texts]
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._pool.reader() as conn:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model=? AND kind=? AND text_hash IN ({placeholders})",
+                    (model, kind, *batch),
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        result = [found.get(h) for h in hashes]
+        hit_count = sum(1 for r in result if r is not None)
+        now = time.time()
+        with self._lock:
+            for h in found:
+                self._touched[(model, kind, h)] = now
+            self.hits += hit_count
+            self.misses += len(result) - hit_count
+            due = bool(self._touched) and time.monotonic() - self._touched_at >= Config.EMBEDDING_CACHE_TOUCH_FLUSH_S
+        if due:
+            self.flush_recency()
+        return result
+
+    def _take_touched(self) -> List[Tuple[float, str, str, str]]:
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.monotonic()
+        return [(used, model, kind, h) for (model, kind, h), used in touched.items()]
+
+    def _write_recency(self, conn, rows: List[Tuple[float, str, str, str]]) -> None:
+        conn.executemany(
+            "UPDATE embeddings SET last_used_at=MAX(last_used_at, ?) WHERE model=? AND kind=? AND text_hash=?",
+            rows,
+        )
+
+    def flush_recency(self) -> None:
+        """Write the buffered hit timestamps in one transaction"""
+        rows = self._take_touched()
+        if rows:
+            with self._pool.writer() as conn:
+                self._write_recency(conn, rows)
+
+    def put_many(self, model: str, kind: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        now = time.time()
+        rows = [
+            (model, kind, content_hash(t), np.asarray(v, dtype=np.float32).tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        with self._pool.writer() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings(model, kind, text_hash, vector, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._count += conn.total_changes - before
+            if self._count > self.max_entries:
+                # Eviction must see every recent hit, or it could drop rows that are in use
+                self._write_recency(conn, self._take_touched())
+                self._evict(conn)
+
+    def _evict(self, conn) -> None:
+        # Trim to 90% of the budget so eviction does not run on every insert
+        excess = self._count - int(self.max_entries * 0.9)
+        conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used_at ASC LIMIT ?)",
+            (excess,),
+        )
+        self._count -= excess
+        self.evictions += excess
+        logger.info("embedding_cache.evict: removed=%d remaining=%d", excess, self._count)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._count,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
@@ -1,17 +1,45 @@
 from groq import Groq
 from config import Config
+from services.llm_cache import LLMResponseCache, llm_cache_key
+from utils.prompt_packer import prompt_budget
+from utils.singleflight import SingleFlight
 import logging
+from typing import Callable, Iterator
 
 logger = logging.getLogger(__name__)
 
+# Returned in place of an answer when the Groq call fails
+GENERATION_FAILED = "I couldn't generate a response at this time."
+
+
+class GenerationStream:
+    """
+    Tokens of a streamed answer. failed is set when the Groq stream errors, before the
+    GENERATION_FAILED token that ends it, so a partial answer is never mistaken for a complete one.
+    """
+
+    def __init__(self, produce: Callable[["GenerationStream"], Iterator[str]]):
+        self.failed = False
+        self._tokens = produce(self)
+
+    def __iter__(self) -> "GenerationStream":
+        return self
+
+    def __next__(self) -> str:
+        return next(self._tokens)
+
+
 class GenerationService:
     _instance = None
+    # Identical prompts in flight at the same time share one upstream call
+    _flight = SingleFlight("generate")
     
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance.client = Groq(api_key=Config.GROQ_API_KEY)
             cls._instance.model = Config.GROQ_MODEL
+            cls._instance.cache = LLMResponseCache()
             logger.info(f"Initialized Groq client with model: {cls._instance.model}")
         return cls._instance
     
@@ -27,6 +55,45 @@ class GenerationService:
         - template: Optional custom template.
         - kwargs: Additional params for future extensibility.
         """
+        prompt = self._build_prompt(user_input, material, task_type, template, **kwargs)
+
+        # Call the AI model (abstracted, e.g., OpenAI, local LLM, etc.); identical prompts are memoized
+        key = self._cache_key(prompt)
+        ai_response = self._flight.do((key, task_type), lambda: self.cache.get_or_compute(
+            key, self.model, task_type,
+            lambda: self._call_ai_model(prompt),
+            cacheable=lambda response: bool(response) and response != GENERATION_FAILED,
+        ))
+        return ai_response
+
+    def material_budget(self, user_input: str, task_type: str = "default", template: str = None, **kwargs) -> int:
+        """Tokens left for material in the prompt generate_response builds from the same arguments"""
+        # One blank character keeps the task's template in place (empty material falls back to user_input)
+        return prompt_budget(self._build_prompt(user_input, " ", task_type, template, **kwargs))
+
+    def _cache_key(self, prompt: str) -> str:
+        return llm_cache_key(self.model, Config.LLM_TEMPERATURE, Config.LLM_MAX_OUTPUT_TOKENS, prompt)
+
+    def stream_response(self, user_input: str, material: str = "", task_type: str = "default", template: str = None, **kwargs) -> GenerationStream:
+        """Same arguments as generate_response, but yields the answer token by token as Groq produces it."""
+        prompt = self._build_prompt(user_input, material, task_type, template, **kwargs)
+        key = self._cache_key(prompt)
+        if self.cache.ttl_for(task_type) > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return GenerationStream(lambda stream: iter([cached]))
+        return GenerationStream(lambda stream: self._stream_and_cache(prompt, key, task_type, stream))
+
+    def _stream_and_cache(self, prompt: str, key: str, task_type: str, stream: GenerationStream) -> Iterator[str]:
+        parts = []
+        for token in self._stream_ai_model(prompt, stream):
+            parts.append(token)
+            yield token
+        response = "".join(parts)
+        if response and not stream.failed:
+            self.cache.put(key, response, self.model, task_type)
+
+    def _build_prompt(self, user_input: str, material: str = "", task_type: str = "default", template: str = None, **kwargs) -> str:
         # Dispatch table for task-specific templates/prompts
         task_templates = {
             "lesson": "Create a structured lesson with sections, summary, and quiz from the following material:\n{material}",
@@ -50,21 +117,36 @@ class GenerationService:
                     prompt = prompt_template.format(user_input=user_input, material=user_input, **kwargs)
                 else:
                     prompt = user_input
-
-        # Call the AI model (abstracted, e.g., OpenAI, local LLM, etc.)
-        ai_response = self._call_ai_model(prompt)
-        return ai_response
+        return prompt
 
     def _call_ai_model(self, prompt: str):
         try:
             response = self.client.chat.completions.create(
                 messages=[{"role": "user", "content": prompt}],
                 model=self.model,
-                temperature=0.3,
-                max_tokens=1024
+                temperature=Config.LLM_TEMPERATURE,
+                max_tokens=Config.LLM_MAX_OUTPUT_TOKENS
             )
             return response.choices[0].message.content
             
         except Exception as e:
             logger.error(f"Generation error: {str(e)}")
-            return "I couldn't generate a response at this time."
\ No newline at end of file
+            return GENERATION_FAILED
+
+    def _stream_ai_model(self, prompt: str, stream: GenerationStream) -> Iterator[str]:
+        try:
+            response = self.client.chat.completions.create(
+                messages=[{"role": "user", "content": prompt}],
+                model=self.model,
+                temperature=Config.LLM_TEMPERATURE,
+                max_tokens=Config.LLM_MAX_OUTPUT_TOKENS,
+                stream=True
+            )
+            for chunk in response:
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    yield token
+        except Exception as e:
+            logger.error(f"Streaming generation error: {str(e)}")
+            stream.failed = True
+            yield GENERATION_FAILED
\ No newline at end of file
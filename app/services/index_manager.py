@@ -103,20 +103,61 @@
 from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
 from llama_index.vector_stores.faiss import FaissVectorStore
 from llama_index.core.embeddings import resolve_embed_model
-from llama_index.core.schema import Document
+from llama_index.core.schema import Document, BaseNode, NodeWithScore
 from config import Config
+from services.index_cache import IndexCache
+from services.content_ledger import ContentLedger
+from services.embedding import CachedEmbedding, embed_nodes_batched
+from services.embedding_cache import EmbeddingCache
+from utils.hashing import content_hash
+from utils.llama_helpers import chunk_document, create_document, page_sections
+from utils.singleflight import SingleFlight
+from utils.faiss_helpers import (
+    INDEX_KINDS, build_index, choose_index_type, configured_metric, index_kind, reconstruct_all, recall_report,
+    search_params, search_top_k,
+)
 import faiss
+import numpy as np
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Any, Tuple, Iterable, Iterator
 import os
 import shutil
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# IndexManager() is first reached from several pool threads at once; only one may build the instance
+_instance_lock = threading.Lock()
 
 class IndexManager:
-    def __init__(self):
-        self.storage_path = Path(Config.STORAGE_PATH)
-        self.storage_path.mkdir(parents=True, exist_ok=True)
-        self.embed_model = resolve_embed_model("local:sentence-transformers/all-MiniLM-L6-v2")
-        self.dimension = 384  # Fixed dimension for all-MiniLM-L6-v2
+    _instance = None
+    _cache = IndexCache(max_bytes=Config.INDEX_CACHE_MAX_BYTES)
+    _course_locks: Dict[str, threading.Lock] = {}
+    _locks_guard = threading.Lock()
+    # Bumped whenever a course's index content changes; lets derived caches detect stale entries
+    _versions: Dict[str, int] = {}
+    # Concurrent cold loads of a course, and identical concurrent searches, run once
+    _load_flight = SingleFlight("index_load")
+    _search_flight = SingleFlight("index_search")
+
+    def __new__(cls):
+        if cls._instance is None:
+            with _instance_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance.storage_path = Path(Config.STORAGE_PATH)
+                    instance.storage_path.mkdir(parents=True, exist_ok=True)
+                    instance.embedding_cache = EmbeddingCache()
+                    inner = resolve_embed_model("local:sentence-transformers/all-MiniLM-L6-v2")
+                    inner.embed_batch_size = Config.EMBED_BATCH_SIZE
+                    instance.embed_model = CachedEmbedding(inner, instance.embedding_cache)
+                    instance.dimension = 384  # Fixed dimension for all-MiniLM-L6-v2
+                    # Published only once fully built, so the unlocked check above never sees a half-made instance
+                    cls._instance = instance
+        return cls._instance
 
     def get_course_storage_path(self, course_id: str) -> Path:
         """Get storage path for a specific course"""
@@ -127,77 +168,355 @@ class IndexManager:
         course_path = self.get_course_storage_path(course_id)
         return course_path.exists() and any(course_path.iterdir())
 
-    def add_documents(self, course_id: str, documents: List[Document]):
-        """Add documents to a course-specific index"""
-        # Create course-specific storage path
-        course_path = self.get_course_storage_path(course_id)
-        course_path.mkdir(parents=True, exist_ok=True)
-        
-        # Create FAISS index and vector store
-        faiss_index = faiss.IndexFlatL2(self.dimension)
-        vector_store = FaissVectorStore(
-            faiss_index=faiss_index,
-        )        
+    def _load_index_from_disk(self, course_path: Path) -> VectorStoreIndex:
+        """Deserialize the FAISS file and docstore for a course directory"""
+        vector_store = FaissVectorStore.from_persist_dir(str(course_path))
+        storage_context = StorageContext.from_defaults(
+            vector_store=vector_store,
+            persist_dir=str(course_path)
+        )
+        return load_index_from_storage(
+            storage_context=storage_context,
+            embed_model=self.embed_model
+        )
+
+    def _estimate_index_bytes(self, index: VectorStoreIndex) -> int:
+        """Rough resident size of a loaded index: raw vectors plus docstore text"""
+        faiss_index = index.storage_context.vector_store._faiss_index
+        vector_bytes = faiss_index.ntotal * faiss_index.d * 4 if faiss_index is not None else 0
+        text_bytes = sum(len(node.get_content()) for node in index.docstore.docs.values())
+        return vector_bytes + text_bytes
+
+    def _load_index(self, course_id: str) -> VectorStoreIndex:
+        """Return the resident index for a course, loading it from disk on a cache miss"""
+        index = self._cache.get(course_id)
+        if index is None:
+            index = self._load_flight.do(course_id, lambda: self._load_and_cache(course_id))
+        return index
+
+    def _load_and_cache(self, course_id: str) -> VectorStoreIndex:
+        # Another caller may have finished loading while this one waited to lead
+        index = self._cache.peek(course_id)
+        if index is None:
+            version = self.index_version(course_id)
+            index = self._load_index_from_disk(self.get_course_storage_path(course_id))
+            # A commit that landed meanwhile has cached a newer index; never replace it with these files
+            if self.index_version(course_id) == version:
+                self._cache.put(course_id, index, self._estimate_index_bytes(index))
+        return index
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters for the resident index cache"""
+        return self._cache.stats()
+
+    def index_version(self, course_id: str) -> int:
+        with self._locks_guard:
+            return self._versions.get(course_id, 0)
+
+    def _bump_version(self, course_id: str) -> None:
+        with self._locks_guard:
+            self._versions[course_id] = self._versions.get(course_id, 0) + 1
+
+    def _course_lock(self, course_id: str) -> threading.Lock:
+        """Per-course lock serializing writers of course_<id>"""
+        with self._locks_guard:
+            return self._course_locks.setdefault(course_id, threading.Lock())
+
+    def _new_index(self, nodes: List[BaseNode]) -> VectorStoreIndex:
+        """Build a fresh in-memory index over the given nodes (embedded beforehand by _embed_nodes)"""
+        faiss_index = build_index("flat", np.zeros((0, self.dimension), dtype="float32"), self.dimension, configured_metric())
+        vector_store = FaissVectorStore(faiss_index=faiss_index)
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
-                
-        # Create index from documents
-        index = VectorStoreIndex.from_documents(
-            documents, 
+        return VectorStoreIndex(
+            nodes=nodes,
             storage_context=storage_context,
             embed_model=self.embed_model,
-            show_progress=True
         )
-        faiss_index = vector_store._faiss_index
-        print(f"Number of vectors stored: {faiss_index.ntotal}")
 
-        # Persist index to course-specific directory
-        storage_context.persist(persist_dir=str(course_path))
-        print(f"Persisted index for course {course_id} at {course_path}")
+    def _embed_nodes(self, course_id: str, nodes: List[BaseNode]) -> None:
+        """Precompute node embeddings in parallel fixed-size batches; index construction then reuses them"""
+        if not nodes:
+            return
+        started = time.perf_counter()
+        batches = sum(1 for _ in embed_nodes_batched(self.embed_model, nodes))
+        elapsed = time.perf_counter() - started
+        logger.info(
+            "index.embed: course=%s chunks=%d batches=%d workers=%d %.1fs (%.1f chunks/s)",
+            course_id, len(nodes), batches, Config.EMBED_WORKERS, elapsed, len(nodes) / max(elapsed, 1e-9),
+        )
 
-    def search(self, course_id: str, query: str, top_k: Optional[int] = None) -> List[Dict]:
-        """Search within a course-specific index"""
+    def _dedupe_nodes(self, documents: List[Document], ledger: ContentLedger) -> Tuple[List[BaseNode], int]:
+        """
+        Chunk documents and drop anything the course ledger has already seen,
+        either as a whole document or as an individual chunk.
+        Returns the nodes that still need embedding and the number of skipped chunks.
+        """
+        new_nodes: List[BaseNode] = []
+        skipped = 0
+        for document in documents:
+            doc_hash = content_hash(document.text)
+            if ledger.has_document(doc_hash):
+                logger.info("index.dedupe: skipping already indexed document %s", doc_hash[:12])
+                skipped += ledger.document_chunks(doc_hash)
+                continue
+            node_ids: List[str] = []
+            fresh = list(self._dedupe_chunks(document, ledger, node_ids))
+            new_nodes.extend(fresh)
+            skipped += len(node_ids) - len(fresh)
+            ledger.record_document(doc_hash, node_ids)
+        return new_nodes, skipped
+
+    def _dedupe_chunks(self, document: Document, ledger: ContentLedger, node_ids: List[str]) -> Iterator[BaseNode]:
+        """
+        Chunk one document and yield the chunks the course ledger has not seen, recording them.
+        The node id of every chunk, new or already indexed, is appended to node_ids.
+        """
+        for node in chunk_document(document):
+            chunk_hash = content_hash(node.get_content())
+            existing_id = ledger.chunk_node_id(chunk_hash)
+            if existing_id is not None:
+                node_ids.append(existing_id)
+                continue
+            node.metadata["content_hash"] = chunk_hash
+            node.excluded_embed_metadata_keys.append("content_hash")
+            node.excluded_llm_metadata_keys.append("content_hash")
+            ledger.record_chunk(chunk_hash, node.node_id)
+            node_ids.append(node.node_id)
+            yield node
+
+    def has_document(self, course_id: str, doc_hash: str) -> bool:
+        """Whether a document with this content hash is already indexed for the course"""
+        return ContentLedger(self.get_course_storage_path(course_id)).has_document(doc_hash)
+
+    def add_documents(self, course_id: str, documents: List[Document], replace: bool = False) -> Dict[str, int]:
+        """
+        Add documents to a course-specific index.
+        New documents are appended to the existing course index, so only they are
+        embedded; pass replace=True to rebuild the course index from scratch.
+        Chunks whose content hash is already in the course ledger are not re-embedded.
+        """
+        course_path = self.get_course_storage_path(course_id)
+
+        with self._course_lock(course_id):
+            rebuild = replace or not self.course_index_exists(course_id)
+            ledger = ContentLedger(course_path)
+            if rebuild:
+                ledger.clear()
+            nodes, skipped = self._dedupe_nodes(documents, ledger)
+            self._embed_nodes(course_id, nodes)
+
+            if rebuild:
+                course_path.mkdir(parents=True, exist_ok=True)
+                index = self._new_index(nodes)
+            elif not nodes:
+                ledger.save()
+                logger.info("index.append: course=%s nothing new (skipped %d chunks)", course_id, skipped)
+                return {"added": 0, "skipped": skipped}
+            else:
+                # Mutate a private copy so concurrent searches keep using the resident index until the swap below
+                index = self._load_index_from_disk(course_path)
+                before = index.storage_context.vector_store._faiss_index.ntotal
+                index.insert_nodes(nodes)
+                logger.info(
+                    "index.append: course=%s chunks=%d skipped=%d vectors %d -> %d",
+                    course_id, len(nodes), skipped, before, index.storage_context.vector_store._faiss_index.ntotal,
+                )
+
+            self._commit_index(course_id, index, ledger)
+        return {"added": len(nodes), "skipped": skipped}
+
+    def add_document_pages(self, course_id: str, doc_hash: str, pages: Iterable[str], metadata: Dict) -> Dict[str, int]:
+        """
+        Streaming add_documents for one document read page by page (see moodle_helpers.iter_file_pages).
+        Consecutive pages are grouped into sections of about INGEST_SECTION_CHARS, chunked, deduplicated,
+        embedded in batches and inserted batch by batch, so only one section and a few embedding
+        batches of the document are in memory at once. doc_hash identifies the document in the ledger.
+        """
+        course_path = self.get_course_storage_path(course_id)
+
+        with self._course_lock(course_id):
+            rebuild = not self.course_index_exists(course_id)
+            ledger = ContentLedger(course_path)
+            if rebuild:
+                ledger.clear()
+            elif ledger.has_document(doc_hash):
+                logger.info("index.dedupe: skipping already indexed document %s", doc_hash[:12])
+                return {"added": 0, "skipped": ledger.document_chunks(doc_hash)}
+
+            node_ids: List[str] = []
+
+            def new_nodes() -> Iterator[BaseNode]:
+                for first, last, text in page_sections(pages, Config.INGEST_SECTION_CHARS):
+                    section = create_document(text, {**metadata, "pages": f"{first}-{last}"})
+                    # Page numbers only locate the text; identical text embeds identically wherever it sits
+                    section.excluded_embed_metadata_keys.append("pages")
+                    yield from self._dedupe_chunks(section, ledger, node_ids)
+
+            # Mutate a private copy so concurrent searches keep using the resident index until the swap
+            index = self._new_index([]) if rebuild else self._load_index_from_disk(course_path)
+            added = 0
+            started = time.perf_counter()
+            for batch in embed_nodes_batched(self.embed_model, new_nodes()):
+                index.insert_nodes(batch)
+                added += len(batch)
+            elapsed = time.perf_counter() - started
+            skipped = len(node_ids) - added
+            logger.info(
+                "index.embed: course=%s chunks=%d skipped=%d workers=%d %.1fs (%.1f chunks/s) streamed",
+                course_id, added, skipped, Config.EMBED_WORKERS, elapsed, added / max(elapsed, 1e-9),
+            )
+            ledger.record_document(doc_hash, node_ids)
+            if rebuild:
+                course_path.mkdir(parents=True, exist_ok=True)
+            elif not added:
+                ledger.save()
+                logger.info("index.append: course=%s nothing new (skipped %d chunks)", course_id, skipped)
+                return {"added": 0, "skipped": skipped}
+            self._commit_index(course_id, index, ledger)
+        return {"added": added, "skipped": skipped}
+
+    def _commit_index(self, course_id: str, index: VectorStoreIndex, ledger: ContentLedger) -> None:
+        """Persist a changed course index with its ledger and make it the resident copy (course lock held)"""
         course_path = self.get_course_storage_path(course_id)
-        
+        self._maybe_rebuild(course_id, index)
+
+        # Persist to a staging directory and swap it in, so a concurrent cold load never reads
+        # a half-written index; the dot prefix keeps staging dirs out of list_courses()
+        token = uuid.uuid4().hex
+        staging = self.storage_path / f".{course_path.name}.{token}.new"
+        index.storage_context.persist(persist_dir=str(staging))
+        ledger.save(staging)
+        retired = self.storage_path / f".{course_path.name}.{token}.old"
+        if course_path.exists():
+            os.replace(course_path, retired)
+        os.replace(staging, course_path)
+        shutil.rmtree(retired, ignore_errors=True)
+        # Version first: a cold load that read the previous files sees the bump and does not cache them
+        self._bump_version(course_id)
+        self._cache.put(course_id, index, self._estimate_index_bytes(index))
+        print(f"Persisted index for course {course_id} at {course_path} "
+              f"({index.storage_context.vector_store._faiss_index.ntotal} vectors)")
+
+    def _maybe_rebuild(self, course_id: str, index: VectorStoreIndex) -> None:
+        """
+        Swap the course's FAISS index for an ANN index once it crosses the size
+        thresholds, and move legacy L2 indexes to the configured metric.
+        Vectors are re-added in their original order, so the position -> node id
+        mapping in the index struct stays valid.
+        """
+        vector_store = index.storage_context.vector_store
+        current = vector_store._faiss_index
+        current_kind = index_kind(current)
+        target_kind = choose_index_type(current.ntotal)
+        metric = configured_metric()
+        promote = INDEX_KINDS.index(target_kind) > INDEX_KINDS.index(current_kind)
+        migrate = current.metric_type != metric
+        if not promote and not migrate:
+            return
+        kind = target_kind if promote else current_kind
+        try:
+            vectors = reconstruct_all(current)
+            if migrate:
+                faiss.normalize_L2(vectors)
+            vector_store._faiss_index = build_index(kind, vectors, current.d, metric)
+            logger.info("index.rebuild: course=%s %s -> %s metric %s -> %s vectors=%d",
+                        course_id, current_kind, kind, current.metric_type, metric, current.ntotal)
+        except RuntimeError as e:
+            logger.warning("index.rebuild: course=%s %s -> %s failed, keeping %s: %s",
+                           course_id, current_kind, kind, current_kind, e)
+
+    def search(self, course_id: str, query: str, top_k: Optional[int] = None, threshold: Optional[float] = None,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> List[NodeWithScore]:
+        """Search within a course-specific index"""
+        return self.search_many(
+            course_id, [query], top_k=top_k, threshold=threshold, nprobe=nprobe, ef_search=ef_search
+        )[0]
+
+    def search_many(self, course_id: str, queries: List[str], top_k: Optional[int] = None, threshold: Optional[float] = None,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> List[List[NodeWithScore]]:
+        """
+        Search several queries against a course index at once.
+        Queries are embedded in one batch and looked up with a single FAISS search
+        over the query matrix; results are returned in the same order as queries.
+        Node scores are cosine similarities; a threshold is applied inside FAISS.
+        nprobe/ef_search tune IVF/HNSW course indexes and are ignored for flat ones.
+        Identical concurrent searches against the same index version share one execution.
+        """
+        key = (course_id, tuple(queries), top_k, threshold, nprobe, ef_search, self.index_version(course_id))
+        results = self._search_flight.do(
+            key, lambda: self._search_many(course_id, queries, top_k, threshold, nprobe, ef_search)
+        )
+        # Callers get their own lists; the nodes themselves are shared read-only
+        return [list(nodes) for nodes in results]
+
+    def _search_many(self, course_id: str, queries: List[str], top_k: Optional[int], threshold: Optional[float],
+                     nprobe: Optional[int], ef_search: Optional[int]) -> List[List[NodeWithScore]]:
+        empty: List[List[NodeWithScore]] = [[] for _ in queries]
+
+        if not queries:
+            return []
         if not self.course_index_exists(course_id):
             print(f"No index found for course {course_id}")
-            return []
-        
-        # Load FAISS vector store
+            return empty
+
+        # Load index (resident across requests)
+        version = self.index_version(course_id)
+        try:
+            index = self._load_index(course_id)
+        except Exception as e:
+            # The read path never deletes course data; the next search simply tries again
+            logger.error("index.load: course=%s failed: %s", course_id, e)
+            # Keep a copy a concurrent commit has just made resident
+            if self.index_version(course_id) == version:
+                self._cache.invalidate(course_id)
+            return empty
+
         try:
-            vector_store = FaissVectorStore.from_persist_dir(str(course_path))
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store,
-                persist_dir=str(course_path)
-            )
-            
-            # Load index
-            index = load_index_from_storage(
-                storage_context=storage_context,
-                embed_model=self.embed_model
-            )
-            
-            # Create retriever
             similarity_top_k = top_k if isinstance(top_k, int) and top_k > 0 else Config.SIMILARITY_TOP_K
-            retriever = index.as_retriever(similarity_top_k=similarity_top_k)
-            
-            # Retrieve results
-            nodes = retriever.retrieve(query)
-            return nodes
-            
+            faiss_index = index.storage_context.vector_store._faiss_index
+            if faiss_index.ntotal == 0:
+                return empty
+
+            query_matrix = np.asarray(self.embed_model.get_query_embedding_batch(queries), dtype="float32")
+            params = search_params(faiss_index, nprobe=nprobe, ef_search=ef_search)
+            rows = search_top_k(faiss_index, query_matrix, similarity_top_k, threshold=threshold, params=params)
+            return [self._to_nodes(index, similarities, positions) for similarities, positions in rows]
         except Exception as e:
-            print(f"Error loading index for course {course_id}: {str(e)}")
-            # Attempt to repair by deleting and recreating
-            shutil.rmtree(course_path, ignore_errors=True)
+            logger.error("index.search: course=%s queries=%d failed: %s", course_id, len(queries), e)
+            return empty
+
+    def _to_nodes(self, index: VectorStoreIndex, similarities, positions) -> List[NodeWithScore]:
+        """Map FAISS row positions back to docstore nodes, as VectorIndexRetriever does"""
+        nodes_dict = index.index_struct.nodes_dict
+        hits = [(str(pos), float(sim)) for sim, pos in zip(similarities, positions)]
+        node_ids = [nodes_dict[pos] for pos, _ in hits]
+        nodes = index.docstore.get_nodes(node_ids)
+        return [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, hits)]
+
+    def ann_report(self, course_id: str, num_queries: int = 100, k: int = 10,
+                   nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> List[Dict]:
+        """Recall@k and latency of each ANN index type against the flat baseline, on this course's vectors"""
+        index = self._load_index(course_id)
+        # Work on a copy: reconstructing from IVF needs a direct map, which mutates the index
+        faiss_index = faiss.clone_index(index.storage_context.vector_store._faiss_index)
+        vectors = reconstruct_all(faiss_index)
+        if len(vectors) == 0:
             return []
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+        return recall_report(vectors, queries, k=k, metric=faiss_index.metric_type, nprobe=nprobe, ef_search=ef_search)
 
     def delete_course_index(self, course_id: str):
         """Delete a course-specific index"""
         course_path = self.get_course_storage_path(course_id)
-        if course_path.exists():
-            shutil.rmtree(course_path)
-            print(f"Deleted index for course {course_id}")
-        else:
-            print(f"No index found for course {course_id}")
+        with self._course_lock(course_id):
+            self._cache.invalidate(course_id)
+            self._bump_version(course_id)
+            if course_path.exists():
+                shutil.rmtree(course_path)
+                print(f"Deleted index for course {course_id}")
+            else:
+                print(f"No index found for course {course_id}")
 
 
     def list_courses(self):
@@ -216,20 +535,9 @@ class IndexManager:
 
             course_id = course_dir.name.replace("course_", "")
             try:
-                # Load FAISS vector store
-                vector_store = FaissVectorStore.from_persist_dir(str(course_dir))
-
-                # Recreate storage context
-                storage_context = StorageContext.from_defaults(
-                    vector_store=vector_store,
-                    persist_dir=str(course_dir)
-                )
-
-                # Load index
-                index = load_index_from_storage(
-                    storage_context=storage_context,
-                    embed_model=self.embed_model
-                )
+                # Reuse a resident index if present, without promoting cold courses into the cache
+                index = self._cache.peek(course_id) or self._load_index_from_disk(course_dir)
+                vector_store = index.storage_context.vector_store
 
                 # Get document count
                 documents = index.docstore.docs
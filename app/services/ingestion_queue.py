@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from config import Config
+from services.session_store import _DB_PATH
+from utils.concurrency import run_io
+from utils.sqlite_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS ingestion_jobs (
+        id TEXT PRIMARY KEY,
+        course_id TEXT NOT NULL,
+        activity_type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        result TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        next_run_at TEXT NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_claim ON ingestion_jobs(status, next_run_at);",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_course ON ingestion_jobs(course_id, status);",
+]
+
+# Runs one job: (activity_type, course_id, payload) -> optional JSON-serializable result
+JobHandler = Callable[[str, str, Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class IngestionQueue:
+    """
+    Persistent ingestion job queue in state.sqlite with an asyncio worker pool.
+    At most one job per course runs at a time (also across processes sharing the
+    database), failed jobs are retried with exponential backoff, and jobs left
+    'running' past their lease (e.g. after a crash) are picked up again.
+    """
+
+    def __init__(self, handler: JobHandler, db_path: Optional[Path] = None):
+        self.handler = handler
+        self.db_path = str(db_path or _DB_PATH)
+        self._pool = get_pool(self.db_path)
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping = False
+        self._init_db()
+
+    def _init_db(self) -> None:
+        with self._pool.writer() as conn:
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+
+    def enqueue(self, course_id: str, activity_type: str, payload: Dict[str, Any]) -> str:
+        """Persist a job and wake an idle worker; safe to call from any thread"""
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        with self._pool.writer() as conn:
+            conn.execute(
+                "INSERT INTO ingestion_jobs(id, course_id, activity_type, payload, status, created_at, updated_at, next_run_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, course_id, activity_type, json.dumps(payload, default=str), now, now, now),
+            )
+        if self._wakeup is not None:
+            # asyncio.Event is not thread-safe; enqueue usually runs in an IO_POOL thread
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._pool.reader() as conn:
+            row = conn.execute(
+                "SELECT id, course_id, activity_type, status, attempts, last_error, result, created_at, updated_at, next_run_at "
+                "FROM ingestion_jobs WHERE id=?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["job_id"] = job.pop("id")
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _claim_next(self) -> Optional[Dict[str, Any]]:
+        """Atomically move the oldest runnable job of an idle course to 'running'"""
+        now = datetime.utcnow()
+        stale_before = (now - timedelta(seconds=Config.INGESTION_JOB_LEASE_S)).isoformat()
+        with self._pool.writer() as conn:
+            # IMMEDIATE takes the database write lock up front, excluding other processes too
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE ingestion_jobs SET status='queued', next_run_at=? WHERE status='running' AND updated_at < ?",
+                (now.isoformat(), stale_before),
+            )
+            row = conn.execute(
+                """
+                SELECT id, course_id, activity_type, payload, attempts FROM ingestion_jobs
+                WHERE status='queued' AND next_run_at <= ?
+                  AND course_id NOT IN (SELECT course_id FROM ingestion_jobs WHERE status='running')
+                ORDER BY created_at LIMIT 1
+                """,
+                (now.isoformat(),),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE ingestion_jobs SET status='running', attempts=attempts+1, updated_at=? WHERE id=?",
+                (now.isoformat(), row["id"]),
+            )
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    def _finish(self, job_id: str, result: Optional[Dict[str, Any]]) -> None:
+        now = datetime.utcnow().isoformat()
+        with self._pool.writer() as conn:
+            conn.execute(
+                "UPDATE ingestion_jobs SET status='done', last_error=NULL, result=?, updated_at=? WHERE id=?",
+                (json.dumps(result, default=str) if result is not None else None, now, job_id),
+            )
+
+    def _requeue(self, job_id: str) -> None:
+        now = datetime.utcnow().isoformat()
+        with self._pool.writer() as conn:
+            conn.execute(
+                "UPDATE ingestion_jobs SET status='queued', updated_at=?, next_run_at=? WHERE id=? AND status='running'",
+                (now, now, job_id),
+            )
+
+    def _heartbeat(self, job_id: str) -> None:
+        with self._pool.writer() as conn:
+            conn.execute(
+                "UPDATE ingestion_jobs SET updated_at=? WHERE id=? AND status='running'",
+                (datetime.utcnow().isoformat(), job_id),
+            )
+
+    async def _keep_leased(self, job_id: str) -> None:
+        """Renew a running job's lease until cancelled, so long jobs are not taken for lost ones"""
+        while True:
+            await asyncio.sleep(Config.INGESTION_HEARTBEAT_S)
+            try:
+                await run_io(self._heartbeat, job_id)
+            except Exception as e:
+                logger.warning("ingest.heartbeat: job=%s failed: %s", job_id, e)
+
+    def _fail(self, job_id: str, attempts: int, error: str) -> None:
+        now = datetime.utcnow()
+        with self._pool.writer() as conn:
+            if attempts >= Config.INGESTION_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE ingestion_jobs SET status='failed', last_error=?, updated_at=? WHERE id=?",
+                    (error, now.isoformat(), job_id),
+                )
+            else:
+                delay = Config.INGESTION_RETRY_BASE_S * (2 ** (attempts - 1))
+                conn.execute(
+                    "UPDATE ingestion_jobs SET status='queued', last_error=?, updated_at=?, next_run_at=? WHERE id=?",
+                    (error, now.isoformat(), (now + timedelta(seconds=delay)).isoformat(), job_id),
+                )
+
+    async def _worker(self, worker_id: int) -> None:
+        while not self._stopping:
+            try:
+                job = await run_io(self._claim_next)
+            except Exception as e:
+                logger.error("ingest.worker%d: claim failed: %s", worker_id, e)
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=Config.INGESTION_POLL_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            logger.info("ingest.start: job=%s course=%s type=%s attempt=%d",
+                        job["id"], job["course_id"], job["activity_type"], job["attempts"])
+            heartbeat = asyncio.create_task(self._keep_leased(job["id"]))
+            try:
+                result = await self.handler(job["activity_type"], job["course_id"], json.loads(job["payload"]))
+            except asyncio.CancelledError:
+                # Shutting down mid-job: hand it back so the next worker (here or in another process) redoes it
+                logger.warning("ingest.cancelled: job=%s re-queued", job["id"])
+                await run_io(self._requeue, job["id"])
+                raise
+            except Exception as e:
+                logger.error("ingest.failed: job=%s attempt=%d: %s", job["id"], job["attempts"], e)
+                await run_io(self._fail, job["id"], job["attempts"], str(e))
+            else:
+                logger.info("ingest.done: job=%s course=%s", job["id"], job["course_id"])
+                await run_io(self._finish, job["id"], result)
+            finally:
+                heartbeat.cancel()
+            # A finished job may unblock queued jobs of the same course
+            self._wakeup.set()
+
+    def start(self, num_workers: Optional[int] = None) -> None:
+        self._stopping = False
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        for i in range(num_workers or Config.INGESTION_WORKERS):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self) -> None:
+        """
+        Stop claiming new jobs and give in-flight ones INGESTION_STOP_TIMEOUT_S to finish.
+        Jobs still running then are cancelled and put back in the queue.
+        """
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=Config.INGESTION_STOP_TIMEOUT_S)
+            if pending:
+                logger.warning("ingest.stop: cancelling %d workers still running jobs", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
@@ -1,15 +1,20 @@
 import json
 import os
+import logging
 from uuid import uuid4
 from pathlib import Path
 from typing import List, Tuple
 
-from utils.moodle_helpers import download_file, extract_file_text
+from services.download_cache import DownloadCache
+from services.text_cache import ExtractedTextCache
 from services.generation import GenerationService
 from services.index_manager import IndexManager
 from utils.llama_helpers import create_document
 from schemas import LessonCreateRequest, LessonCreateResponse, LessonSection
 from config import Config
+from utils.concurrency import run_cpu, run_io
+
+logger = logging.getLogger(__name__)
 
 
 class LessonService:
@@ -18,7 +23,7 @@ class LessonService:
 
     async def create_lesson(self, request: LessonCreateRequest) -> LessonCreateResponse:
         # 1) Download and extract material
-        file_path, text = self._load_material(request.material_url, request.material_type)
+        file_path, text = await self._load_material(request.material_url, request.material_type)
 
         # 2) Generate lesson content (strict JSON)
         template = (
@@ -36,7 +41,8 @@ class LessonService:
         )
 
         ai = GenerationService()
-        ai_output = ai.generate_response(
+        ai_output = await run_io(
+            ai.generate_response,
             user_input=request.prompt or "",
             material=text,
             task_type="lesson",
@@ -47,10 +53,10 @@ class LessonService:
 
         # 3) Persist lesson locally
         lesson_id = str(uuid4())
-        self._persist_lesson(request.course_id, lesson_id, title, summary, sections, quiz)
+        await run_io(self._persist_lesson, request.course_id, lesson_id, title, summary, sections, quiz)
 
         # 4) Index lesson content back into course index
-        self._index_lesson(request.course_id, title, sections)
+        await run_cpu(self._index_lesson, request.course_id, title, sections)
 
         # 5) Return structured response
         return LessonCreateResponse(
@@ -61,11 +67,12 @@ class LessonService:
             quiz=quiz,
         )
 
-    def _load_material(self, material_url: str, material_type: str) -> Tuple[str, str]:
+    async def _load_material(self, material_url: str, material_type: str) -> Tuple[str, str]:
         suffix = f".{material_type.lower()}" if not material_type.startswith(".") else material_type
-        file_path = download_file(material_url, suffix=suffix)
+        download = await DownloadCache().fetch(material_url)
+        file_path = download.path
         if material_type.lower() in ["pdf", "pptx", "docx"]:
-            text = extract_file_text(file_path, suffix)
+            text = await ExtractedTextCache().load_text(file_path, download.sha256, suffix)
         elif material_type.lower() in ["mp4", "avi", "mov", "mkv"]:
             # Placeholder: implement transcription later
             raise ValueError("Video transcription not implemented yet. Please use pdf/pptx/docx for now.")
@@ -112,4 +119,6 @@ class LessonService:
             }
             docs.append(create_document(text, metadata))
         if docs:
-            self.index_manager.add_documents(course_id, docs)
\ No newline at end of file
+            # Sections already in the course ledger (same text hash) are skipped without re-embedding
+            result = self.index_manager.add_documents(course_id, docs)
+            logger.info("lesson.index: course=%s added=%d skipped=%d", course_id, result["added"], result["skipped"])
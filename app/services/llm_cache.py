@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from config import Config
+from utils.sqlite_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+_DB_PATH = Path(Config.STORAGE_PATH) / "llm_cache.sqlite"
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS llm_responses (
+        key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        task_type TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_llm_responses_expiry ON llm_responses(expires_at);",
+]
+
+
+def llm_cache_key(model: str, temperature: float, max_tokens: int, prompt: str) -> str:
+    """Exact-match key: same model, sampling settings and prompt text"""
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{model}|{temperature}|{max_tokens}|{digest}"
+
+
+class LLMResponseCache:
+    """
+    Memoizes LLM responses by llm_cache_key. A bounded in-memory LRU sits in
+    front of a SQLite tier (storage/llm_cache.sqlite); entries live for the
+    TTL configured for their task_type in LLM_CACHE_TTL_S (0 disables caching
+    for that task). Concurrent identical calls are coalesced by the caller
+    (GenerationService), so a miss here is computed once.
+    """
+    _instance = None
+
+    def __new__(cls, db_path: Optional[Path] = None):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._pool = get_pool(db_path or _DB_PATH)
+            cls._instance._memory = OrderedDict()  # key -> (response, expires_at)
+            cls._instance._lock = threading.Lock()
+            cls._instance.memory_hits = 0
+            cls._instance.disk_hits = 0
+            cls._instance.misses = 0
+            cls._instance.stores = 0
+            cls._instance._init_db()
+        return cls._instance
+
+    def _init_db(self) -> None:
+        with self._pool.writer() as conn:
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            conn.execute("DELETE FROM llm_responses WHERE expires_at < ?", (time.time(),))
+
+    @staticmethod
+    def ttl_for(task_type: str) -> float:
+        ttls = Config.LLM_CACHE_TTL_S
+        return ttls.get(task_type, ttls.get("default", 0))
+
+    def _remember(self, key: str, response: str, expires_at: float) -> None:
+        # Caller holds self._lock
+        self._memory[key] = (response, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > Config.LLM_CACHE_MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                if cached[1] > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return cached[0]
+                del self._memory[key]
+        with self._pool.reader() as conn:
+            row = conn.execute(
+                "SELECT response, expires_at FROM llm_responses WHERE key=? AND expires_at > ?", (key, now)
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row["response"], row["expires_at"])
+        return row["response"]
+
+    def put(self, key: str, response: str, model: str, task_type: str) -> None:
+        ttl = self.ttl_for(task_type)
+        if ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now + ttl)
+            self.stores += 1
+            prune = self.stores % 1000 == 0
+        with self._pool.writer() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_responses(key, model, task_type, response, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, task_type, response, now, now + ttl),
+            )
+            if prune:
+                conn.execute("DELETE FROM llm_responses WHERE expires_at < ?", (now,))
+
+    def get_or_compute(self, key: str, model: str, task_type: str, compute: Callable[[], str],
+                       cacheable: Callable[[str], bool] = bool) -> str:
+        """Cached response for key, or compute() and store it; results rejected by cacheable are not stored"""
+        if self.ttl_for(task_type) <= 0:
+            return compute()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = compute()
+        if cacheable(response):
+            self.put(key, response, model, task_type)
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0,
+            }
@@ -1,6 +1,11 @@
-from utils.moodle_helpers import download_file, extract_file_text
+from services.download_cache import DownloadCache
+from services.text_cache import ExtractedTextCache
 from services.generation import GenerationService
 from schemas import ResourceGenerateRequest, ResourceGenerateResponse, LessonPage, QuizQuestion
+from utils.concurrency import run_io
+import logging
+
+logger = logging.getLogger(__name__)
 
 class ResourceService:
     async def generate(self, request: ResourceGenerateRequest) -> ResourceGenerateResponse:
@@ -8,9 +13,10 @@ class ResourceService:
         material = ""
         if request.file_url:
             ext = request.file_url.split('.')[-1].lower()
-            file_path = download_file(request.file_url, suffix=f".{ext}")
+            download = await DownloadCache().fetch(request.file_url)
+            file_path = download.path
             if ext in ["pdf", "pptx", "docx"]:
-                material = extract_file_text(file_path, f".{ext}")
+                material = await ExtractedTextCache().load_text(file_path, download.sha256, f".{ext}")
             elif ext in ["mp4", "avi"]:
                 material = self.extract_video_text(file_path)
             else:
@@ -18,16 +24,17 @@ class ResourceService:
         # 2. Compose AI prompt
         prompt = request.prompt or self.default_prompt(request.type)
         ai_input = f"{prompt}\n\nMaterial:\n{material}" if material else prompt
-        print(f"AI Input: {ai_input}")  # Debugging output
+        logger.debug("AI Input: %s", ai_input)
         # 3. Generate resource using AI
         ai = GenerationService()
-        ai_output = ai.generate_response(
+        ai_output = await run_io(
+            ai.generate_response,
             user_input=ai_input,
             material=material,
             task_type=request.type,
             options=request.options or {}
         )
-        print(f"AI Output: {ai_output}")  # Debugging output
+        logger.debug("AI Output: %s", ai_output)
         # 4. Parse AI output into structured response
         return self.parse_output(request.type, ai_output, request.options)
 
@@ -1,11 +1,16 @@
-import sqlite3
+import logging
 import threading
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 
 from config import Config
+from utils.sqlite_pool import get_pool
+
+logger = logging.getLogger(__name__)
 
 _DB_PATH = Path(Config.STORAGE_PATH) / "state.sqlite"
 _DB_PATH.parent.mkdir(parents=True, exist_ok=True)
@@ -32,45 +37,100 @@ _SCHEMA = [
         FOREIGN KEY(session_id) REFERENCES sessions(id)
     );
     """,
-    "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, created_at);",
+    # Covering index: thread reads and cursor pages are answered from the index without touching the table
+    "CREATE INDEX IF NOT EXISTS idx_messages_session_cover ON messages(session_id, created_at, id, role, content);",
+    "DROP INDEX IF EXISTS idx_messages_session;",
     "CREATE INDEX IF NOT EXISTS idx_sessions_course ON sessions(course_id, last_active_at);",
 ]
 
+# Columns added after the first release, created on existing databases at startup
+_MIGRATIONS = {
+    "sessions": [
+        # created_at of the newest message folded into summary_text
+        ("summary_upto", "TEXT"),
+    ],
+}
 
-class SessionStore:
-    _lock = threading.RLock()
 
-    def __init__(self, db_path: Optional[Path] = None):
-        self.db_path = str(db_path or _DB_PATH)
-        self._init_db()
+@dataclass
+class SessionContext:
+    """What a chat turn needs about a session, loaded with a single query"""
+    session_id: str
+    course_id: str
+    status: str
+    messages: List[Dict] = field(default_factory=list)  # newest window of the thread, oldest first
+    truncated: bool = False  # older messages exist beyond the window
+    summary: str = ""  # rolling summary of the conversation up to summary_upto
+    summary_upto: Optional[str] = None
+
+    def recent(self, n: int) -> List[Dict]:
+        return self.messages[-n:] if n > 0 else []
+
+    def unsummarized(self) -> List[Dict]:
+        """Messages newer than the rolling summary"""
+        if not self.summary_upto:
+            return list(self.messages)
+        return [m for m in self.messages if m["created_at"] > self.summary_upto]
+
+
+class SessionStore:
+    """
+    Chat sessions and messages in state.sqlite; reads use pooled reader connections and never wait on writes.
+    Messages are written behind: add_message buffers them and a background thread commits each batch in
+    one transaction. Reads merge the buffer in, so a session always sees its own messages.
+    One shared instance exists per database file, so every caller sees the same buffer.
+    """
+    _instances: Dict[str, "SessionStore"] = {}
+    _instances_guard = threading.Lock()
 
-    def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def __new__(cls, db_path: Optional[Path] = None):
+        key = str(db_path or _DB_PATH)
+        with cls._instances_guard:
+            if key not in cls._instances:
+                instance = super().__new__(cls)
+                instance.db_path = key
+                instance._pool = get_pool(key)
+                instance._pending = []  # (id, session_id, role, content, created_at)
+                instance._pending_lock = threading.Lock()
+                instance._flush_lock = threading.Lock()
+                instance._wakeup = threading.Event()
+                instance._stopping = False
+                instance._flusher = None
+                instance._contexts = OrderedDict()
+                instance._contexts_lock = threading.RLock()
+                instance._init_db()
+                cls._instances[key] = instance
+            return cls._instances[key]
 
     def _init_db(self) -> None:
-        with self._connect() as conn, self._lock:
-            cur = conn.cursor()
+        with self._pool.writer() as conn:
             for stmt in _SCHEMA:
-                cur.execute(stmt)
-            conn.commit()
+                conn.execute(stmt)
+            for table, columns in _MIGRATIONS.items():
+                existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+                for name, decl in columns:
+                    if name not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
 
     def create_session(self, course_id: str, title: Optional[str] = None) -> str:
         session_id = str(uuid.uuid4())
         now = datetime.utcnow().isoformat()
-        with self._connect() as conn, self._lock:
+        with self._pool.writer() as conn:
             conn.execute(
                 "INSERT INTO sessions(id, course_id, title, summary_text, status, created_at, last_active_at) VALUES (?, ?, ?, ?, 'active', ?, ?)",
                 (session_id, course_id, title, "", now, now),
             )
-            conn.commit()
+        self._cache_context(SessionContext(session_id=session_id, course_id=course_id, status="active"))
         return session_id
 
     def end_session(self, session_id: str, summary_text: Optional[str] = None) -> Optional[str]:
-        with self._connect() as conn, self._lock:
-            # If no summary provided, build a naive one from last few messages
-            if not summary_text:
+        # If no summary provided, use the rolling summary, or build a naive one from last few messages
+        ctx = self.get_context(session_id)
+        summary_upto = ctx.summary_upto if ctx is not None else None
+        if not summary_text:
+            if ctx is not None and ctx.summary:
+                summary_text = ctx.summary
+            else:
                 msgs = self.get_messages(session_id, limit=6)
                 parts = []
                 for m in msgs:
@@ -78,61 +138,265 @@ class SessionStore:
                     content = m.get("content", "")
                     parts.append(f"{role}: {content}")
                 summary_text = "\n".join(parts)[:2000]
-            now = datetime.utcnow().isoformat()
-            conn.execute(
-                "UPDATE sessions SET status='ended', summary_text=?, last_active_at=? WHERE id=?",
-                (summary_text or "", now, session_id),
-            )
-            conn.commit()
-            return summary_text or ""
-
-    def add_message(self, session_id: str, role: str, content: str) -> None:
-        msg_id = str(uuid.uuid4())
+                summary_upto = msgs[-1]["created_at"] if msgs else summary_upto
         now = datetime.utcnow().isoformat()
-        with self._connect() as conn, self._lock:
+        with self._pool.writer() as conn:
             conn.execute(
-                "INSERT INTO messages(id, session_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
-                (msg_id, session_id, role, content, now),
+                "UPDATE sessions SET status='ended', summary_text=?, summary_upto=?, last_active_at=? WHERE id=?",
+                (summary_text or "", summary_upto, now, session_id),
             )
+        with self._contexts_lock:
+            ctx = self._contexts.get(session_id)
+            if ctx is not None:
+                ctx.status = "ended"
+                ctx.summary = summary_text or ""
+                ctx.summary_upto = summary_upto
+        return summary_text or ""
+
+    def set_summary(self, session_id: str, summary_text: str, summary_upto: str) -> None:
+        """Store a rolling summary covering every message up to and including created_at == summary_upto"""
+        with self._pool.writer() as conn:
             conn.execute(
-                "UPDATE sessions SET last_active_at=? WHERE id=?",
-                (now, session_id),
+                "UPDATE sessions SET summary_text=?, summary_upto=? WHERE id=?",
+                (summary_text, summary_upto, session_id),
             )
-            conn.commit()
+        with self._contexts_lock:
+            ctx = self._contexts.get(session_id)
+            if ctx is not None:
+                ctx.summary = summary_text
+                ctx.summary_upto = summary_upto
+
+    def add_message(self, session_id: str, role: str, content: str) -> Dict:
+        msg_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        message = {"id": msg_id, "role": role, "content": content, "created_at": now}
+        with self._contexts_lock:
+            with self._pending_lock:
+                self._pending.append((msg_id, session_id, role, content, now))
+                full = len(self._pending) >= Config.SESSION_FLUSH_MAX_BATCH
+            ctx = self._contexts.get(session_id)
+            if ctx is not None:
+                ctx.messages.append(dict(message))
+                if len(ctx.messages) > Config.SESSION_CONTEXT_MAX_MESSAGES:
+                    del ctx.messages[0]
+                    ctx.truncated = True
+        self._ensure_flusher()
+        if full:
+            self._wakeup.set()
+        return message
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._instances_guard:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._stopping = False
+                    self._flusher = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+                    self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stopping:
+            self._wakeup.wait(Config.SESSION_FLUSH_INTERVAL_S)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Messages stay buffered and are retried on the next tick
+                logger.error(f"Failed to flush buffered chat messages: {e}")
+
+    def flush(self) -> int:
+        """Commit every buffered message in one transaction; returns how many were written"""
+        with self._flush_lock:
+            with self._pending_lock:
+                batch = list(self._pending)
+            if not batch:
+                return 0
+            last_active: Dict[str, str] = {}
+            for _, session_id, _, _, created_at in batch:
+                last_active[session_id] = max(created_at, last_active.get(session_id, ""))
+            with self._pool.writer() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO messages(id, session_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+                conn.executemany(
+                    "UPDATE sessions SET last_active_at=? WHERE id=? AND last_active_at < ?",
+                    [(ts, sid, ts) for sid, ts in last_active.items()],
+                )
+            # Drop the batch only once committed. A reader that queries the DB before this commit and looks
+            # at the buffer after this line would miss the batch, so readers snapshot the buffer first
+            # (see _merge_pending)
+            with self._pending_lock:
+                del self._pending[:len(batch)]
+            return len(batch)
+
+    def stop(self) -> None:
+        """Stop the background flusher and write out anything still buffered"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=Config.SESSION_FLUSH_INTERVAL_S * 4)
+            self._flusher = None
+        self.flush()
+
+    def _pending_for(self, session_id: str) -> List[Dict]:
+        with self._pending_lock:
+            return [
+                {"id": msg_id, "role": role, "content": content, "created_at": created_at}
+                for msg_id, sid, role, content, created_at in self._pending
+                if sid == session_id
+            ]
+
+    def _merge_pending(self, pending: List[Dict], rows: List[Dict]) -> List[Dict]:
+        """
+        Merge DB rows with a snapshot of the session's buffered messages. The snapshot must be taken
+        before the query: a message gone from the buffer by then was already committed, so the query
+        sees it. A row may be both committed and still in the snapshot, so merge by id.
+        """
+        merged = {r["id"]: r for r in rows}
+        for r in pending:
+            merged.setdefault(r["id"], r)
+        return sorted(merged.values(), key=lambda r: (r["created_at"], r["id"]))
 
     def get_messages(self, session_id: str, limit: int = 12) -> List[Dict]:
-        with self._connect() as conn, self._lock:
+        pending = self._pending_for(session_id)
+        with self._pool.reader() as conn:
             cur = conn.execute(
-                "SELECT role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at DESC LIMIT ?",
+                "SELECT id, role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at DESC LIMIT ?",
                 (session_id, limit),
             )
-            rows = list(cur.fetchall())
-        rows.reverse()
-        return [dict(r) for r in rows]
+            rows = [dict(r) for r in cur.fetchall()]
+        return self._merge_pending(pending, rows)[-limit:]
 
     def get_session_messages(self, session_id: str, limit: int = 200) -> List[Dict]:
-        with self._connect() as conn, self._lock:
+        pending = self._pending_for(session_id)
+        with self._pool.reader() as conn:
             cur = conn.execute(
-                "SELECT role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at ASC LIMIT ?",
+                "SELECT id, role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at ASC LIMIT ?",
                 (session_id, limit),
             )
-            return [dict(r) for r in cur.fetchall()]
+            rows = [dict(r) for r in cur.fetchall()]
+        return self._merge_pending(pending, rows)[:limit]
+
+    def _message_cursor(self, session_id: str, message_id: str) -> Optional[Tuple[str, str]]:
+        for m in self._pending_for(session_id):
+            if m["id"] == message_id:
+                return m["created_at"], m["id"]
+        with self._pool.reader() as conn:
+            row = conn.execute(
+                "SELECT created_at, id FROM messages WHERE session_id=? AND id=?", (session_id, message_id)
+            ).fetchone()
+        return (row["created_at"], row["id"]) if row is not None else None
+
+    def get_messages_page(self, session_id: str, after_created_at: Optional[str] = None,
+                          since_message_id: Optional[str] = None, limit: int = 50) -> Tuple[List[Dict], bool]:
+        """
+        Messages strictly after a cursor, oldest first, plus whether more follow.
+        The cursor is a created_at timestamp or, for an exact position, the id of
+        the last message the client already has. Raises KeyError for an unknown id.
+        """
+        cursor: Tuple[str, str] = ("", "")
+        if since_message_id:
+            found = self._message_cursor(session_id, since_message_id)
+            if found is None:
+                raise KeyError(since_message_id)
+            cursor = found
+        elif after_created_at:
+            # A timestamp cursor skips every message at that instant
+            cursor = (after_created_at, "\uffff")
+        pending = self._pending_for(session_id)
+        with self._pool.reader() as conn:
+            cur = conn.execute(
+                "SELECT id, role, content, created_at FROM messages "
+                "WHERE session_id=? AND (created_at > ? OR (created_at = ? AND id > ?)) "
+                "ORDER BY created_at, id LIMIT ?",
+                (session_id, cursor[0], cursor[0], cursor[1], limit + 1),
+            )
+            rows = [dict(r) for r in cur.fetchall()]
+        messages = [m for m in self._merge_pending(pending, rows) if (m["created_at"], m["id"]) > cursor]
+        return messages[:limit], len(messages) > limit
 
     def delete_session(self, session_id: str) -> None:
-        with self._connect() as conn, self._lock:
-            conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
-            conn.execute("DELETE FROM sessions WHERE id=?", (session_id,))
-            conn.commit()
+        # Hold the flush lock so an in-flight batch cannot re-insert this session's messages afterwards
+        with self._flush_lock:
+            with self._pending_lock:
+                self._pending = [m for m in self._pending if m[1] != session_id]
+            with self._contexts_lock:
+                self._contexts.pop(session_id, None)
+            with self._pool.writer() as conn:
+                conn.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
+                conn.execute("DELETE FROM sessions WHERE id=?", (session_id,))
+
+    def _cache_context(self, ctx: SessionContext) -> None:
+        with self._contexts_lock:
+            self._contexts[ctx.session_id] = ctx
+            self._contexts.move_to_end(ctx.session_id)
+            while len(self._contexts) > Config.SESSION_CONTEXT_CACHE_SIZE:
+                self._contexts.popitem(last=False)
+
+    def _load_context(self, session_id: str) -> Optional[SessionContext]:
+        window = Config.SESSION_CONTEXT_MAX_MESSAGES
+        # Holding the flush lock means no buffered message can be committed and
+        # dropped from the buffer between this read and the merge below
+        with self._flush_lock:
+            with self._pool.reader() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT s.course_id, s.status, s.summary_text, s.summary_upto, m.id, m.role, m.content, m.created_at
+                    FROM sessions s
+                    LEFT JOIN (
+                        SELECT id, session_id, role, content, created_at FROM messages
+                        WHERE session_id=? ORDER BY created_at DESC LIMIT ?
+                    ) m ON m.session_id = s.id
+                    WHERE s.id=?
+                    """,
+                    (session_id, window + 1, session_id),
+                ).fetchall()
+            if not rows:
+                return None
+            committed = [
+                {"id": r["id"], "role": r["role"], "content": r["content"], "created_at": r["created_at"]}
+                for r in rows if r["id"] is not None
+            ]
+            # Merge and cache under the contexts lock, so later appends find the cached context
+            with self._contexts_lock:
+                merged = {m["id"]: m for m in committed}
+                for m in self._pending_for(session_id):
+                    merged.setdefault(m["id"], m)
+                messages = sorted(merged.values(), key=lambda m: m["created_at"])
+                ctx = SessionContext(
+                    session_id=session_id,
+                    course_id=rows[0]["course_id"],
+                    status=rows[0]["status"],
+                    messages=messages[-window:],
+                    truncated=len(messages) > window,
+                    summary=rows[0]["summary_text"] or "",
+                    summary_upto=rows[0]["summary_upto"],
+                )
+                self._cache_context(ctx)
+        return ctx
+
+    def get_context(self, session_id: str) -> Optional[SessionContext]:
+        """Session state plus its latest messages; served from the in-process cache after the first load"""
+        with self._contexts_lock:
+            ctx = self._contexts.get(session_id)
+            if ctx is not None:
+                self._contexts.move_to_end(session_id)
+                return replace(ctx, messages=list(ctx.messages))
+        ctx = self._load_context(session_id)
+        return replace(ctx, messages=list(ctx.messages)) if ctx is not None else None
 
     def session_exists(self, session_id: str) -> bool:
-        with self._connect() as conn, self._lock:
+        with self._contexts_lock:
+            if session_id in self._contexts:
+                return True
+        with self._pool.reader() as conn:
             cur = conn.execute("SELECT 1 FROM sessions WHERE id=?", (session_id,))
             return cur.fetchone() is not None
 
     def list_sessions(self, course_id: str, limit: int = 20) -> List[Dict]:
-        with self._connect() as conn, self._lock:
+        with self._pool.reader() as conn:
             cur = conn.execute(
                 "SELECT id, title, status, created_at, last_active_at FROM sessions WHERE course_id=? ORDER BY last_active_at DESC LIMIT ?",
                 (course_id, limit),
             )
-            return [dict(r) for r in cur.fetchall()] 
\ No newline at end of file
+            return [dict(r) for r in cur.fetchall()]
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from config import Config
+from utils.concurrency import run_cpu
+from utils.extraction_pool import ExtractionPool
+from utils.moodle_helpers import EXTRACTOR_VERSION, iter_file_pages, join_pages
+from utils.page_files import read_pages, write_pages
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractedTextCache:
+    """
+    Extracted text of downloaded files, keyed by the SHA-256 of the file bytes, the file type
+    and EXTRACTOR_VERSION. Each entry is a gzip JSON-lines file with one page per line under
+    storage/extracted_text/, so a file is parsed once however many lessons, resources and index
+    entries are built from it, and cached pages can be read back one at a time.
+    Async callers use ensure() first, which extracts missing entries in the ExtractionPool
+    worker processes; the sync methods extract in the calling thread when needed.
+    """
+    _instance = None
+
+    def __new__(cls, root: Optional[Path] = None):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.root = Path(root or Path(Config.STORAGE_PATH) / "extracted_text")
+            cls._instance.root.mkdir(parents=True, exist_ok=True)
+            cls._instance._lock = threading.Lock()
+            cls._instance._inflight = {}  # entry path -> asyncio.Task
+            cls._instance.hits = 0
+            cls._instance.misses = 0
+        return cls._instance
+
+    def _entry_path(self, digest: str, file_type: str) -> Path:
+        return self.root / digest[:2] / f"{digest}{file_type}.v{EXTRACTOR_VERSION}.jsonl.gz"
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    async def ensure(self, file_path: str, digest: str, file_type: str) -> None:
+        """Make sure the entry for this file exists, extracting it in a worker process if not"""
+        entry = self._entry_path(digest, file_type)
+        if entry.exists():
+            self._count(hit=True)
+            return
+        task = self._inflight.get(entry)
+        if task is None:
+            self._count(hit=False)
+            task = self._inflight[entry] = asyncio.ensure_future(
+                ExtractionPool().extract(file_path, file_type, entry)
+            )
+            task.add_done_callback(lambda _: self._inflight.pop(entry, None))
+        pages = await asyncio.shield(task)
+        logger.info("text_cache.store: %s%s pages=%d", digest[:12], file_type, pages)
+
+    async def load_text(self, file_path: str, digest: str, file_type: str) -> str:
+        """extract_file_text through the cache, extracting in a worker process on a miss"""
+        await self.ensure(file_path, digest, file_type)
+        return await run_cpu(self.text, file_path, digest, file_type)
+
+    def pages(self, file_path: str, digest: str, file_type: str) -> Iterator[str]:
+        """
+        iter_file_pages for a file whose bytes hash to digest. Read from the cache when present;
+        otherwise extracted here, and each page written to the cache as it is yielded.
+        """
+        entry = self._entry_path(digest, file_type)
+        if entry.exists():
+            return read_pages(entry)
+        self._count(hit=False)
+        return write_pages(iter_file_pages(file_path, file_type), entry)
+
+    def text(self, file_path: str, digest: str, file_type: str) -> str:
+        """extract_file_text, through the cache"""
+        return join_pages(self.pages(file_path, digest, file_type), file_type)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
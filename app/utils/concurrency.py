@@ -0,0 +1,43 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from config import Config
+
+# CPU-bound work (embedding, FAISS, text extraction); torch/faiss release the GIL while they run
+CPU_POOL = ThreadPoolExecutor(max_workers=Config.CPU_POOL_SIZE or os.cpu_count() or 4, thread_name_prefix="cpu")
+# Blocking network and database calls (Groq, file downloads, SQLite)
+IO_POOL = ThreadPoolExecutor(max_workers=Config.IO_POOL_SIZE, thread_name_prefix="io")
+# Embedding batches of an ingestion; separate so work already running on CPU_POOL can fan out without deadlocking
+EMBED_POOL = ThreadPoolExecutor(max_workers=Config.EMBED_WORKERS, thread_name_prefix="embed")
+
+
+async def run_cpu(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a CPU-bound callable on the CPU pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_POOL, functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a blocking IO callable on the IO pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(IO_POOL, functools.partial(fn, *args, **kwargs))
+
+
+async def iterate_in_pool(iterator: Iterator[Any], pool: Optional[ThreadPoolExecutor] = None) -> AsyncIterator[Any]:
+    """Drive a blocking iterator (e.g. an LLM token stream) from the event loop, one item per pool call"""
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    while True:
+        item = await loop.run_in_executor(pool or IO_POOL, next, iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
+
+
+def shutdown_pools() -> None:
+    CPU_POOL.shutdown(wait=True)
+    IO_POOL.shutdown(wait=True)
+    EMBED_POOL.shutdown(wait=True)
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from config import Config
+from utils.moodle_helpers import iter_file_pages
+from utils.page_files import write_pages
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionError(Exception):
+    """A file could not be extracted: parser error, timeout, crashed worker or full queue"""
+
+
+def _extract_to_file(file_path: str, file_type: str, entry_path: str) -> int:
+    """Runs in a worker process: extract file_path page by page into a page file, returning the page count"""
+    pages = 0
+    for _ in write_pages(iter_file_pages(file_path, file_type), Path(entry_path)):
+        pages += 1
+    return pages
+
+
+def _worker_main(conn) -> None:
+    """Worker process loop: run each (function, args) task received on conn and send back its outcome"""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            conn.send(("ok", fn(*args)))
+        except Exception as e:
+            # Exceptions from parser libraries are not always picklable, so only their text crosses over
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    """One extraction process and the pipe it takes tasks on"""
+
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), name="extraction-worker", daemon=True)
+        self.process.start()
+        child.close()
+        self.tasks = 0
+
+    def kill(self) -> None:
+        # A running task cannot be interrupted, so the process is killed; the waiting recv() then sees EOF
+        self.process.kill()
+        self.process.join(timeout=5)
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+
+class ExtractionPool:
+    """
+    Document parsing in worker processes (one per core unless EXTRACTION_WORKERS is set), so
+    PDF/PPTX/DOCX extraction scales with cores instead of sharing the API process's GIL, and a
+    parser that hangs or crashes on a malformed file cannot take the API worker down with it.
+    At most one file per worker is running; up to EXTRACTION_QUEUE_SIZE more wait their turn and
+    further files are refused. Each worker has its own pipe, so a file running longer than
+    EXTRACTION_TIMEOUT_S has only its own worker killed and replaced; a file whose worker
+    crashed is retried once on a fresh one. Files on other workers are not affected.
+    The concurrency limit is bound to the application's event loop (start(), or the first extract()).
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super().__new__(cls)
+                instance.workers = Config.EXTRACTION_WORKERS or os.cpu_count() or 1
+                # spawn: workers must not inherit the API process's threads, locks and loaded models
+                instance._ctx = multiprocessing.get_context("spawn")
+                instance._lock = threading.Lock()
+                instance._idle: List[_Worker] = []
+                instance._all: Set[_Worker] = set()
+                # Threads blocked in a worker's recv(); one per running file, plus killed ones draining
+                instance._waiters = ThreadPoolExecutor(max_workers=instance.workers * 2, thread_name_prefix="extraction-wait")
+                instance._loop: Optional[asyncio.AbstractEventLoop] = None
+                instance._slots: Optional[asyncio.Semaphore] = None
+                instance.waiting = 0
+                instance.completed = 0
+                instance.failed = 0
+                instance.timeouts = 0
+                instance.restarts = 0
+                cls._instance = instance
+            return cls._instance
+
+    def start(self) -> None:
+        """Bind the pool to the running (application) event loop"""
+        with self._lock:
+            if self._slots is None:
+                self._loop = asyncio.get_running_loop()
+                self._slots = asyncio.Semaphore(self.workers)
+
+    def _slot(self) -> asyncio.Semaphore:
+        self.start()
+        if asyncio.get_running_loop() is not self._loop:
+            raise RuntimeError("ExtractionPool is bound to the application event loop")
+        return self._slots
+
+    def _take(self) -> _Worker:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        worker = _Worker(self._ctx)
+        with self._lock:
+            self._all.add(worker)
+        return worker
+
+    def _give_back(self, worker: _Worker) -> None:
+        if worker.tasks >= Config.EXTRACTION_TASKS_PER_CHILD:
+            # Replaced after a number of files to cap parser memory growth
+            self._forget(worker)
+            worker.stop()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def _discard(self, worker: _Worker) -> None:
+        """Kill a worker that hung, died or was abandoned mid-file; the next file starts a fresh one"""
+        self._forget(worker)
+        worker.kill()
+
+    def _forget(self, worker: _Worker) -> None:
+        with self._lock:
+            self._all.discard(worker)
+
+    async def extract(self, file_path: str, file_type: str, entry_path: Path) -> int:
+        """Extract file_path into the page file at entry_path in a worker process; returns the page count"""
+        slots = self._slot()
+        with self._lock:
+            if self.waiting >= Config.EXTRACTION_QUEUE_SIZE:
+                raise ExtractionError(f"Extraction queue is full ({self.waiting} files waiting)")
+            self.waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        try:
+            return await self._run(file_path, file_type, entry_path)
+        finally:
+            slots.release()
+
+    async def _call(self, worker: _Worker, fn: Callable, args: Tuple) -> Tuple[str, Any]:
+        worker.tasks += 1
+        worker.conn.send((fn, args))
+        return await asyncio.wait_for(
+            self._loop.run_in_executor(self._waiters, worker.conn.recv), timeout=Config.EXTRACTION_TIMEOUT_S
+        )
+
+    async def _run(self, file_path: str, file_type: str, entry_path: Path) -> int:
+        for attempt in (1, 2):
+            worker = self._take()
+            try:
+                status, value = await self._call(worker, _extract_to_file, (file_path, file_type, str(entry_path)))
+            except asyncio.TimeoutError:
+                self._discard(worker)
+                self.restarts += 1
+                self.timeouts += 1
+                self.failed += 1
+                raise ExtractionError(f"Extracting {file_path} timed out after {Config.EXTRACTION_TIMEOUT_S}s")
+            except (EOFError, OSError):
+                # The worker died mid-file (or before taking it)
+                self._discard(worker)
+                self.restarts += 1
+                if attempt == 2:
+                    self.failed += 1
+                    raise ExtractionError(f"Extraction worker crashed on {file_path}")
+                logger.warning("extraction.retry: worker died while extracting %s", file_path)
+                continue
+            except BaseException:
+                # Cancelled mid-file: the worker's reply would be read by the next file, so it goes
+                self._discard(worker)
+                raise
+            self._give_back(worker)
+            if status == "error":
+                self.failed += 1
+                raise ExtractionError(f"Extracting {file_path} failed: {value}")
+            self.completed += 1
+            return value
+
+    def shutdown(self) -> None:
+        with self._lock:
+            workers, self._all, self._idle = list(self._all), set(), []
+        for worker in workers:
+            worker.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "processes": len(self._all),
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+        }
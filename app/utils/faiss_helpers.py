@@ -0,0 +1,178 @@
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from config import Config
+
+# Index kinds in promotion order; a course only ever moves to the right
+INDEX_KINDS = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """Pick the FAISS index kind for a course of the given size"""
+    if Config.ANN_INDEX_TYPE != "auto":
+        return Config.ANN_INDEX_TYPE
+    if num_vectors < Config.ANN_PROMOTE_THRESHOLD:
+        return "flat"
+    if num_vectors < Config.ANN_PQ_THRESHOLD:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def index_kind(index: faiss.Index) -> str:
+    """Inverse of build_index: classify a loaded FAISS index"""
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    try:
+        ivf = faiss.downcast_index(faiss.extract_index_ivf(index))
+    except RuntimeError:
+        return "flat"
+    return "ivf_pq" if isinstance(ivf, faiss.IndexIVFPQ) else "ivf_flat"
+
+
+def configured_metric() -> int:
+    """FAISS metric for new course indexes; inner product over unit vectors is cosine similarity"""
+    return faiss.METRIC_INNER_PRODUCT if Config.VECTOR_METRIC == "ip" else faiss.METRIC_L2
+
+
+def to_similarity(distances: np.ndarray, metric: int) -> np.ndarray:
+    """
+    Convert raw FAISS scores to cosine similarity (higher is better).
+    Embeddings are unit length, so squared L2 distance d relates to cosine as 1 - d/2.
+    """
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        return distances
+    return 1.0 - distances / 2.0
+
+
+def _radius(threshold: float, metric: int) -> float:
+    # Inverse of to_similarity: IP keeps scores above the radius, L2 keeps distances below it
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        return threshold
+    return 2.0 * (1.0 - threshold)
+
+
+def search_top_k(index: faiss.Index, queries: np.ndarray, k: int,
+                 threshold: Optional[float] = None, params=None) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Top-k search returning (cosine similarities, positions) per query, best first.
+    With a threshold the cut-off is applied inside FAISS via range search, so
+    candidates below it are never materialized.
+    """
+    if threshold is None:
+        distances, positions = index.search(queries, k, params=params)
+        rows = []
+        for row_dists, row_positions in zip(distances, positions):
+            keep = row_positions >= 0
+            rows.append((to_similarity(row_dists[keep], index.metric_type), row_positions[keep]))
+        return rows
+
+    try:
+        lims, distances, positions = index.range_search(queries, _radius(threshold, index.metric_type), params=params)
+    except RuntimeError:
+        # Not every index type implements range search; filter a plain top-k instead
+        return [
+            (sims[sims >= threshold], pos[sims >= threshold])
+            for sims, pos in search_top_k(index, queries, k, params=params)
+        ]
+    rows = []
+    for i in range(len(queries)):
+        sims = to_similarity(distances[lims[i]:lims[i + 1]], index.metric_type)
+        row_positions = positions[lims[i]:lims[i + 1]]
+        order = np.argsort(-sims)[:k]
+        rows.append((sims[order], row_positions[order]))
+    return rows
+
+
+def _nlist(num_vectors: int) -> int:
+    # ~4*sqrt(n) lists, with enough training points per centroid
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39 or 1))
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    # Largest divisor of the dimension giving sub-vectors of at least 8 dims
+    for m in range(dimension // 8, 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def _factory_string(kind: str, dimension: int, num_vectors: int) -> str:
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf_flat":
+        return f"IVF{_nlist(num_vectors)},Flat"
+    if kind == "ivf_pq":
+        return f"IVF{_nlist(num_vectors)},PQ{_pq_subquantizers(dimension)}"
+    if kind == "hnsw":
+        return f"HNSW{Config.ANN_HNSW_M}"
+    raise ValueError(f"Unknown FAISS index type: {kind}")
+
+
+def build_index(kind: str, vectors: np.ndarray, dimension: int, metric: int = faiss.METRIC_L2) -> faiss.Index:
+    """Create, train (if needed) and fill an index of the given kind; row order is preserved"""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    index = faiss.index_factory(dimension, _factory_string(kind, dimension, len(vectors)), metric)
+    if not index.is_trained:
+        index.train(vectors)
+    if len(vectors):
+        index.add(vectors)
+    return index
+
+
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    """Read every stored vector back out of an index, in insertion order"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    if index_kind(index) in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Per-call search parameters, so tuning one request never mutates the shared index"""
+    kind = index_kind(index)
+    if kind in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or Config.ANN_NPROBE)
+    if kind == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=ef_search or Config.ANN_EF_SEARCH)
+    return None
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                  kinds: Optional[List[str]] = None, metric: int = faiss.METRIC_L2,
+                  nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> List[Dict]:
+    """
+    Build each index kind over the same vectors and compare it with the exact
+    flat baseline: recall@k of the neighbour ids and mean per-query latency.
+    """
+    dimension = vectors.shape[1]
+    k = min(k, len(vectors))
+    baseline = build_index("flat", vectors, dimension, metric)
+    start = time.perf_counter()
+    _, truth = baseline.search(queries, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+    report = [{"index_type": "flat", "recall_at_k": 1.0, "latency_ms": flat_ms}]
+    for kind in kinds or [kd for kd in INDEX_KINDS if kd != "flat"]:
+        try:
+            index = build_index(kind, vectors, dimension, metric)
+        except RuntimeError as e:
+            report.append({"index_type": kind, "error": str(e)})
+            continue
+        params = search_params(index, nprobe, ef_search)
+        start = time.perf_counter()
+        _, found = index.search(queries, k, params=params)
+        latency_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+        hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+        report.append({
+            "index_type": kind,
+            "recall_at_k": hits / float(truth.size),
+            "latency_ms": latency_ms,
+            "nprobe": getattr(params, "nprobe", None),
+            "ef_search": getattr(params, "efSearch", None),
+        })
+    return report
@@ -0,0 +1,17 @@
+import hashlib
+import re
+
+
+def content_hash(text: str) -> str:
+    """SHA-256 of whitespace-normalized text, used to recognise re-sent content"""
+    normalized = re.sub(r"\s+", " ", text or "").strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def file_hash(path: str, chunk_bytes: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,7 +1,7 @@
 from llama_index.core import Document
 from llama_index.core.node_parser import SentenceSplitter
 from config import Config
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 def create_document(text: str, metadata: Dict) -> Document:
     """Create LlamaIndex document with metadata"""
@@ -19,4 +19,26 @@ def chunk_document(document: Document) -> List[Document]:
         chunk_overlap=Config.CHUNK_OVERLAP,
         include_metadata=True
     )
-    return parser.get_nodes_from_documents([document])
\ No newline at end of file
+    return parser.get_nodes_from_documents([document])
+
+def page_sections(pages: Iterable[str], max_chars: int) -> Iterator[Tuple[int, int, str]]:
+    """
+    Group consecutive pages into sections of about max_chars characters, so short slides
+    still chunk together; yields (first_page, last_page, text) with 1-based page numbers.
+    """
+    parts: List[str] = []
+    size = 0
+    first = 1
+    page_no = 0
+    for page_no, text in enumerate(pages, start=1):
+        if not text or not text.strip():
+            continue
+        if not parts:
+            first = page_no
+        parts.append(text)
+        size += len(text)
+        if size >= max_chars:
+            yield first, page_no, "\n".join(parts)
+            parts, size = [], 0
+    if parts:
+        yield first, page_no, "\n".join(parts)
@@ -1,35 +1,93 @@
-import httpx
-from pathlib import Path
-import os
-import mimetypes
-import asyncio
-from loguru import logger
-from config import Config
-import socket
-import time
 from datetime import datetime
-import requests
-import tempfile
-def download_file(url, suffix):
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise ValueError(f"Failed to download file from URL: {url}")
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(response.content)
-        return tmp.name
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Iterable, Iterator, List
 
-def extract_file_text(file_path: str, file_type: str) -> str:
-    """Extract text from various file types using LlamaIndex readers"""
-    if file_type in [".pdf", ".docx", ".pptx"]:
-        print(f"Extracting text from {file_path} of type {file_type}")
-        from llama_index.core import SimpleDirectoryReader
-        reader = SimpleDirectoryReader(input_files=[file_path])
-        print(f"Extracting text from {file_path} with reader {reader}")
-        documents = reader.load_data()
-        return "\n".join([d.text for d in documents])
+# Bump whenever extracted text changes for the same file, so the extracted-text cache re-extracts
+EXTRACTOR_VERSION = 1
+# DOCX has no stored page layout beyond Word's rendered breaks; also cut a "page" after this many characters
+_DOCX_PAGE_CHARS = 8000
+
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+_P_NS = "http://schemas.openxmlformats.org/presentationml/2006/main"
+_R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+
+def _iter_pdf_pages(file_path: str) -> Iterator[str]:
+    from pypdf import PdfReader  # installed with llama-index-readers-file
+
+    reader = PdfReader(file_path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def _iter_pptx_slides(file_path: str) -> Iterator[str]:
+    with zipfile.ZipFile(file_path) as archive:
+        # Slides in presentation order (slideN.xml numbering does not follow reordering)
+        rels = ET.fromstring(archive.read("ppt/_rels/presentation.xml.rels"))
+        targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+        presentation = ET.fromstring(archive.read("ppt/presentation.xml"))
+        for slide_id in presentation.iter(f"{{{_P_NS}}}sldId"):
+            target = targets.get(slide_id.get(f"{{{_R_NS}}}id"))
+            if not target:
+                continue
+            name = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("ppt", target))
+            slide = ET.fromstring(archive.read(name))
+            paragraphs = ("".join(t.text or "" for t in p.iter(f"{{{_A_NS}}}t")) for p in slide.iter(f"{{{_A_NS}}}p"))
+            yield "\n".join(text for text in paragraphs if text.strip())
+
+
+def _iter_docx_pages(file_path: str) -> Iterator[str]:
+    page: List[str] = []
+    size = 0
+    with zipfile.ZipFile(file_path) as archive, archive.open("word/document.xml") as body:
+        for _, element in ET.iterparse(body, events=("end",)):
+            if element.tag != f"{{{_W_NS}}}p":
+                continue
+            breaks = any(
+                br.tag == f"{{{_W_NS}}}lastRenderedPageBreak" or br.get(f"{{{_W_NS}}}type") == "page"
+                for br in element.iter()
+            )
+            if page and (breaks or size >= _DOCX_PAGE_CHARS):
+                yield "\n".join(page)
+                page, size = [], 0
+            text = "".join(t.text or "" for t in element.iter(f"{{{_W_NS}}}t"))
+            # Drop the parsed paragraph so the tree never holds more than the current one
+            element.clear()
+            if text.strip():
+                page.append(text)
+                size += len(text)
+    if page:
+        yield "\n".join(page)
+
+
+def iter_file_pages(file_path: str, file_type: str) -> Iterator[str]:
+    """
+    Yield the text of a file one page at a time (PDF pages, PPTX slides, DOCX pages;
+    lines of anything else read as plain text), so callers never hold the whole document.
+    """
+    if file_type == ".pdf":
+        yield from _iter_pdf_pages(file_path)
+    elif file_type == ".pptx":
+        yield from _iter_pptx_slides(file_path)
+    elif file_type == ".docx":
+        yield from _iter_docx_pages(file_path)
     else:  # Plain text
         with open(file_path, "r") as f:
-            return f.read()
+            yield from f
+
+
+def join_pages(pages: Iterable[str], file_type: str) -> str:
+    """Whole text from iter_file_pages output (plain-text lines keep their own newlines)"""
+    separator = "" if file_type not in [".pdf", ".docx", ".pptx"] else "\n"
+    return separator.join(pages)
+
+
+def extract_file_text(file_path: str, file_type: str) -> str:
+    """Extract the whole text of a file (see iter_file_pages for large files)"""
+    return join_pages(iter_file_pages(file_path, file_type), file_type)
 
 def normalize_moodle_date(timestamp: int) -> datetime:
     return datetime.fromtimestamp(timestamp)
\ No newline at end of file
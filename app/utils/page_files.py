@@ -0,0 +1,35 @@
+import gzip
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Iterable, Iterator
+
+
+def read_pages(path: Path) -> Iterator[str]:
+    """Pages of a gzip JSON-lines page file, one at a time"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def write_pages(pages: Iterable[str], path: Path) -> Iterator[str]:
+    """
+    Pass pages through while writing them to a gzip JSON-lines file at path.
+    The file appears (atomically) only once every page was written; a failed
+    or abandoned iteration leaves nothing behind.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Unique name per writer: concurrent writers of one path each publish a complete file
+    part = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+    complete = False
+    try:
+        with gzip.open(part, "wt", encoding="utf-8") as f:
+            for page in pages:
+                f.write(json.dumps(page) + "\n")
+                yield page
+        os.replace(part, path)
+        complete = True
+    finally:
+        if not complete:
+            part.unlink(missing_ok=True)
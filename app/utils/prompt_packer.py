@@ -0,0 +1,158 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a characters-per-token estimate
+    tiktoken = None
+
+# Rough characters per token for English text when no tokenizer is available
+_CHARS_PER_TOKEN = 4
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+_WORD = re.compile(r"[a-z0-9]{3,}")
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    try:
+        # Groq's Llama/Mixtral tokenizers are not in tiktoken; cl100k is a close stand-in for budgeting
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable ({e}); estimating tokens from characters")
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    if not text:
+        return 0
+    enc = _encoding(model or Config.GROQ_MODEL)
+    if enc is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _encoding(model or Config.GROQ_MODEL)
+    if enc is None:
+        limit = max_tokens * _CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit].rstrip() + " ..."
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens]).rstrip() + " ..."
+
+
+def prompt_budget(fixed_prompt: str) -> int:
+    """Input tokens left for history and context once the fixed prompt parts and the answer are reserved"""
+    reserved = Config.LLM_MAX_OUTPUT_TOKENS + Config.PROMPT_SAFETY_TOKENS + count_tokens(fixed_prompt)
+    return max(0, Config.LLM_CONTEXT_WINDOW - reserved)
+
+
+def oldest_that_fit(messages: List[Dict], max_tokens: int) -> List[Dict]:
+    """
+    The longest run of the oldest messages whose fit_history lines fit in max_tokens
+    (at least the first message, which fit_history then truncates if it is too long on its own)
+    """
+    used = 0
+    for i, m in enumerate(messages):
+        used += count_tokens(f"{m['role'].capitalize()}: {m['content']}") + 1
+        if used > max_tokens:
+            return messages[:max(i, 1)]
+    return list(messages)
+
+
+def fit_history(messages: List[Dict], max_tokens: int) -> str:
+    """Format the newest messages that fit in max_tokens as 'Role: content' lines, oldest first"""
+    lines: List[str] = []
+    used = 0
+    for m in reversed(messages):
+        line = f"{m['role'].capitalize()}: {m['content']}"
+        cost = count_tokens(line) + 1
+        if used + cost > max_tokens:
+            if not lines:
+                # Always keep at least the tail of the latest message
+                lines.append(truncate_to_tokens(line, max_tokens))
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return "\n".join(lines)
+
+
+def select_sentences(text: str, query: str, max_tokens: int) -> str:
+    """
+    Keep the sentences sharing the most terms with the query (earlier ones win ties)
+    until max_tokens is spent, and return them in their original order.
+    """
+    sentences = [s.strip() for s in _SENTENCE_SPLIT.split(text) if s and s.strip()]
+    if not sentences:
+        return ""
+    terms = set(_WORD.findall(query.lower()))
+    costs = [count_tokens(s) + 1 for s in sentences]
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(terms.intersection(_WORD.findall(sentences[i].lower()))), i),
+    )
+    chosen: List[int] = []
+    used = 0
+    for i in ranked:
+        if used + costs[i] <= max_tokens:
+            chosen.append(i)
+            used += costs[i]
+    if not chosen:
+        return truncate_to_tokens(sentences[ranked[0]], max_tokens)
+    chosen.sort()
+    parts = [sentences[chosen[0]]]
+    for prev, cur in zip(chosen, chosen[1:]):
+        parts.append(("" if cur == prev + 1 else "... ") + sentences[cur])
+    return " ".join(parts)
+
+
+def fit_sources(texts: List[str], query: str, max_tokens: int, overhead_per_source: int = 0) -> List[str]:
+    """
+    Fit ranked source texts into max_tokens. Sources that fit their fair share are kept
+    whole and their slack goes to the rest; longer ones are cut down to the sentences
+    most relevant to the query. If even a minimal share does not fit, the lowest-ranked
+    sources are dropped, so the result is a prefix of texts in rank order.
+    """
+    n = len(texts)
+    while n > 1 and max_tokens // n - overhead_per_source < Config.PROMPT_MIN_SOURCE_TOKENS:
+        n -= 1
+    texts = texts[:n]
+    needs = [count_tokens(t) for t in texts]
+    alloc = [0] * n
+    remaining = max_tokens - overhead_per_source * n
+    pending = list(range(n))
+    # Water-filling: satisfy everything under the fair share, then split what is left evenly
+    while pending and remaining > 0:
+        share = remaining // len(pending)
+        small = [i for i in pending if needs[i] <= share]
+        if not small:
+            for i in pending:
+                alloc[i] = share
+            alloc[pending[0]] += remaining - share * len(pending)
+            break
+        for i in small:
+            alloc[i] = needs[i]
+            remaining -= needs[i]
+        pending = [i for i in pending if needs[i] > share]
+
+    packed = []
+    for text, need, budget in zip(texts, needs, alloc):
+        packed.append(text if need <= budget else select_sentences(text, query, budget))
+    return packed
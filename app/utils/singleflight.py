@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, TypeVar
+
+T = TypeVar("T")
+
+_groups: List["SingleFlight"] = []
+_groups_guard = threading.Lock()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it is in flight block and share its
+    result (or exception). Nothing is cached once the call completes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+        self.errors = 0
+        with _groups_guard:
+            _groups.append(self)
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            self.calls += 1
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.executions += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self.errors += 1
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "deduplicated": self.shared,
+                "errors": self.errors,
+                "in_flight": len(self._inflight),
+                "dedup_rate": (self.shared / self.calls) if self.calls else 0.0,
+            }
+
+
+def singleflight_stats() -> Dict[str, Dict[str, Any]]:
+    """Counters of every SingleFlight group in the process, by name"""
+    with _groups_guard:
+        return {group.name: group.stats() for group in _groups}
@@ -0,0 +1,108 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Union
+
+from config import Config
+
+
+class SQLitePool:
+    """
+    Connections to one SQLite database in WAL mode: a single writer connection
+    guarded by a lock, plus a pool of reader connections. WAL lets readers run
+    concurrently with the writer, so reads never wait on the write lock.
+    Each connection keeps its own prepared-statement cache.
+    """
+
+    def __init__(self, db_path: Union[str, Path], readers: int = None):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._write_lock = threading.Lock()
+        self._writer = self._open()
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._max_readers = readers or Config.SQLITE_READ_POOL_SIZE
+        self._opened_readers = 0
+        self._readers_guard = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=Config.SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=Config.SQLITE_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable across application crashes in WAL mode; only an OS crash can drop the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(Config.SQLITE_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_guard:
+            if self._opened_readers < self._max_readers:
+                self._opened_readers += 1
+                return self._open()
+        return self._readers.get()
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a read-only connection; it sees the latest committed snapshot"""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Exclusive access to the writer connection; commits on success, rolls back on error"""
+        with self._write_lock:
+            try:
+                yield self._writer
+                if self._writer.in_transaction:
+                    self._writer.commit()
+            except BaseException:
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+                raise
+
+    def close(self) -> None:
+        with self._write_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools: Dict[str, SQLitePool] = {}
+_pools_guard = threading.Lock()
+
+
+def get_pool(db_path: Union[str, Path]) -> SQLitePool:
+    """Process-wide pool for a database file, shared by every store that uses it"""
+    key = str(Path(db_path).resolve())
+    with _pools_guard:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SQLitePool(key)
+        return pool
+
+
+def close_pools() -> None:
+    with _pools_guard:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
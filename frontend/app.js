@@ -25,9 +25,30 @@ function addMessage(role, content, createdAt) {
 function renderThread(messages) {
   const log = el('chatLog');
   log.innerHTML = '';
+  appendMessages(messages);
+}
+
+// /chat returns only the messages added by the turn; older ones are already on screen
+function appendMessages(messages) {
   (messages || []).forEach(m => addMessage(m.role, m.content, m.created_at));
 }
 
+// Fetch a session's whole thread through the paginated messages endpoint
+async function loadThread(sessionId) {
+  const messages = [];
+  let cursor = '';
+  for (;;) {
+    const url = `${state.api}/chat/session/${encodeURIComponent(sessionId)}/messages?limit=200${cursor ? `&since_message_id=${encodeURIComponent(cursor)}` : ''}`;
+    const res = await fetch(url);
+    if (!res.ok) break;
+    const page = await res.json();
+    messages.push(...page.messages);
+    cursor = page.next_cursor || '';
+    if (!page.has_more) break;
+  }
+  return messages;
+}
+
 function renderSources(sources) {
   const container = el('sources');
   if (!sources || !sources.length) { container.innerHTML = ''; return; }
@@ -98,6 +119,8 @@ async function sendMessage() {
   try {
     state.sending = true;
     el('btnSend').disabled = true;
+    // A session id typed in by hand: show its earlier messages first
+    if (state.sessionId && !el('chatLog').children.length) renderThread(await loadThread(state.sessionId));
     const res = await fetch(`${state.api}/chat`, {
       method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload)
     });
@@ -108,7 +131,7 @@ async function sendMessage() {
     }
     const data = await res.json();
     if (data.session_id && !state.sessionId) setSession(data.session_id);
-    renderThread(data.messages || []);
+    appendMessages(data.messages || []);
     renderSources(data.sources || []);
     el('message').value = '';
   } finally {
@@ -141,11 +164,6 @@ async function sendMessage() {
     log.scrollTop = log.scrollHeight;
   }
 
-  function renderWidgetThread(messages) {
-    log.innerHTML = '';
-    (messages || []).forEach(m => addMsg(m.role, m.content, m.created_at));
-  }
-
   function renderWidgetSources(list) {
     if (!list || !list.length) { sources.innerHTML = ''; return; }
     const items = list.map((s, i) => {
@@ -182,7 +200,7 @@ async function sendMessage() {
       const data = await res.json();
       // Prefer returned session id if present
       if (data.session_id && !widgetSessionId) widgetSessionId = data.session_id;
-      renderWidgetThread(data.messages || []);
+      (data.messages || []).forEach(m => addMsg(m.role, m.content, m.created_at));
       renderWidgetSources(data.sources || []);
       input.value = '';
     } catch (e) {